@@ -22,7 +22,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import models, transaction
-from django.db.models import F, Max, Q
+from django.db.models import Max, Q
 from django.forms import modelform_factory
 from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
                          HttpResponseForbidden, HttpResponseRedirect)
@@ -34,7 +34,10 @@ from django.utils.html import format_html
 
 from cms.admin import PageBaseAdmin
 from cms.apps.pages.models import (Country, CountryGroup, Page,
-                                   PageSearchAdapter, get_registered_content)
+                                   PageSearchAdapter, content_registry,
+                                   get_registered_content, lock_page_tree,
+                                   move_page_branch)
+from cms.apps.pages.tree import invalidate_page_tree
 
 # Used to track references to and from the JS sitemap.
 from cms.apps.pages.utils import duplicate_page, publish_page
@@ -437,7 +440,7 @@ class PageAdmin(PageBaseAdmin):
         if not super().has_change_permission(request, obj):
             return False
         if obj:
-            content_model = ContentType.objects.get_for_id(obj.content_type_id).model_class()
+            content_model = content_registry.get(obj.content_type_id).model
             content_opts = content_model._meta
             return request.user.has_perm('{0}.{1}'.format(
                 content_opts.app_label,
@@ -450,7 +453,7 @@ class PageAdmin(PageBaseAdmin):
         if not super().has_delete_permission(request, obj):
             return False
         if obj:
-            content_model = ContentType.objects.get_for_id(obj.content_type_id).model_class()
+            content_model = content_registry.get(obj.content_type_id).model
             content_opts = content_model._meta
             return request.user.has_perm('{0}.{1}'.format(
                 content_opts.app_label,
@@ -747,28 +750,20 @@ class PageAdmin(PageBaseAdmin):
         if not self.has_change_permission(request):
             return HttpResponseForbidden('You do not have permission to move this page.')
 
-        # Lock entire table.
-        existing_pages_list = Page.objects.all().exclude(
-            is_canonical_page=False,
-        ).select_for_update().values(
-            'id',
-            'parent_id',
-            'left',
-            'right',
-            'title'
-        ).order_by('left')
-        existing_pages = dict(
-            (page['id'], page)
-            for page
-            in existing_pages_list
-        )
+        lock_page_tree()
 
         # Get the page.
-        page = existing_pages[int(request.POST['page'])]
-        parent_id = page['parent_id']
+        page = get_object_or_404(
+            Page._base_manager.filter(owner_id__isnull=True, version_for_id__isnull=True).values('id', 'parent_id', 'left', 'right'),
+            id=int(request.POST['page']),
+        )
 
         # Get all the siblings.
-        siblings = [s for s in existing_pages_list if s['parent_id'] == parent_id]
+        siblings = list(Page._base_manager.filter(
+            parent_id=page['parent_id'],
+            owner_id__isnull=True,
+            version_for_id__isnull=True,
+        ).values('id', 'left', 'right').order_by('left'))
 
         # Find the page to swap.
         direction = request.POST['direction']
@@ -792,43 +787,11 @@ class PageAdmin(PageBaseAdmin):
         # Put the pages in order.
         first_page, second_page = sorted((page, other_page), key=lambda p: p['left'])
 
-        # Excise the first page.
-        Page.objects.filter(left__gte=first_page['left'], right__lte=first_page['right']).update(
-            left=F('left') * -1,
-            right=F('right') * -1,
-        )
-
-        # Move the other page.
-        branch_width = first_page['right'] - first_page['left'] + 1
-        Page.objects.filter(left__gte=second_page['left'], right__lte=second_page['right']).update(
-            left=F('left') - branch_width,
-            right=F('right') - branch_width,
-        )
-
-        # Put the page back in.
-        second_branch_width = second_page['right'] - second_page['left'] + 1
-        Page.objects.filter(left__lte=-first_page['left'], right__gte=-first_page['right']).update(
-            left=(F('left') - second_branch_width) * -1,
-            right=(F('right') - second_branch_width) * -1,
-        )
+        # Move the first page to just after the second one.
+        move_page_branch(first_page['left'], first_page['right'], second_page['right'] + 1)
 
-        # Update all content models to match the left and right of their parents.
-        existing_pages_list = Page.objects.all().exclude(
-            is_canonical_page=True,
-        ).select_for_update().values(
-            'id',
-            'parent_id',
-            'owner',
-            'left',
-            'right',
-            'title'
-        ).order_by('left')
-
-        for child_page in existing_pages_list:
-            child_page.update(
-                left=F('owner__left'),
-                right=F('owner__right'),
-            )
+        # The tree was rewritten with update(), which sends no signals.
+        invalidate_page_tree()
 
         # Report back.
         return HttpResponse('Page #%s was moved %s.' % (page['id'], direction))
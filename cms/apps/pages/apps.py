@@ -6,6 +6,12 @@ class PagesAppConfig(AppConfig):
     name = 'cms.apps.pages'
 
     def ready(self):
+        # Connects the signal handlers that keep the country map up to date.
+        from cms.apps.pages import localisation  # noqa
+        # Connects the signal handlers that keep the processed HTML cache up
+        # to date.
+        from cms.html import connect_signals
+        connect_signals()
         from cms.apps.pages.models import PageSearchAdapter
         Page = self.get_model('Page')
         watson.register(Page, PageSearchAdapter)
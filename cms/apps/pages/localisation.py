@@ -0,0 +1,229 @@
+'''
+Lookups used to localise pages.
+
+LocalisationMiddleware needs to look up a country on every request. The
+Country table is tiny and rarely changes, so it is held in memory and
+reloaded in every process whenever a country or country group is saved or
+deleted.
+
+Navigation menus show the titles of the translated pages for the visitor's
+country group. These are held in the default cache for each group, so that
+localising a menu doesn't cost any queries.
+'''
+import threading
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+
+class CountryMap:
+
+    '''
+    Holds every Country by its lower case code, reloading them whenever the
+    shared country version changes.
+    '''
+
+    version_key = 'cms.apps.pages.localisation.countries.version'
+
+    def __init__(self):
+        '''Initializes the CountryMap.'''
+        self._lock = threading.Lock()
+        self._data = None
+
+    def get_version(self):
+        '''Returns the current version token of the countries.'''
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    def _load(self, version):
+        country_model = apps.get_model('pages', 'Country')
+        countries = {}
+        default = None
+        for country in country_model.objects.select_related('group').order_by('pk'):
+            countries.setdefault(country.code.lower(), country)
+            if country.default:
+                default = country
+        return countries, default, version
+
+    def _get(self):
+        version = self.get_version()
+        data = self._data
+        if data is None or data[2] != version:
+            with self._lock:
+                data = self._data
+                if data is None or data[2] != version:
+                    data = self._load(version)
+                    self._data = data
+        return data
+
+    @property
+    def codes(self):
+        '''The lower case codes of every country.'''
+        return frozenset(self._get()[0])
+
+    def get(self, code):
+        '''Returns the country with the given code, ignoring case, or None.'''
+        return self._get()[0].get((code or '').lower())
+
+    def split_path(self, path):
+        '''
+        Splits a country prefix off the given path, returning the country and
+        the rest of the path, or None and the path if it has no valid prefix.
+        '''
+        end = path.find('/', 1)
+        if end > 1 and path[0] == '/':
+            country = self._get()[0].get(path[1:end])
+            if country is not None:
+                return country, path[end:]
+        return None, path
+
+    def get_or_default(self, code):
+        '''
+        Returns the country with the given code, ignoring case, or the default
+        country if there isn't one.
+        '''
+        return self.get(code) or self._get()[1]
+
+    def invalidate(self):
+        '''Marks the countries as changed in every process.'''
+        self._data = None
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+
+
+# A single, thread-safe country map.
+countries = CountryMap()
+
+
+def invalidate_countries():
+    '''
+    Invalidates the country map now and again when the current transaction
+    commits, so that a map loaded by another process before the commit is not
+    kept.
+    '''
+    countries.invalidate()
+    transaction.on_commit(countries.invalidate)
+
+
+@receiver(post_save, sender='pages.Country')
+@receiver(post_delete, sender='pages.Country')
+@receiver(post_save, sender='pages.CountryGroup')
+@receiver(post_delete, sender='pages.CountryGroup')
+def countries_changed(sender, **kwargs):
+    invalidate_countries()
+
+
+class TranslationIndex:
+
+    '''
+    The titles of the translated pages for each country group, by the ID of
+    the canonical page they translate. Each group's index is kept in the
+    default cache and rebuilt after a translation in it is saved or deleted.
+    '''
+
+    key_prefix = 'cms.apps.pages.localisation.translations'
+
+    fields = ('owner_id', 'title', 'short_title', 'is_online', 'publication_date', 'expiry_date')
+
+    def get_key(self, country_group_id):
+        return f'{self.key_prefix}.{country_group_id}'
+
+    def _load(self, country_group_id):
+        page_model = apps.get_model('pages', 'Page')
+        rows = page_model._base_manager.filter(
+            owner_id__isnull=False,
+            version_for_id__isnull=True,
+            country_group_id=country_group_id,
+        ).values_list(*self.fields)
+        return dict((row[0], row[1:]) for row in rows)
+
+    def get(self, country_group_id):
+        '''Returns the index for the given country group.'''
+        key = self.get_key(country_group_id)
+        translations = cache.get(key)
+        if translations is None:
+            translations = self._load(country_group_id)
+            cache.set(key, translations, getattr(settings, 'LOCALISATION_TRANSLATIONS_CACHE_TIMEOUT', 3600))
+        return translations
+
+    def get_titles(self, country_group_id, published=False):
+        '''
+        Returns the navigation titles of the translated pages for the given
+        country group, by the ID of the canonical page they translate.
+        '''
+        now = timezone.now().replace(second=0, microsecond=0)
+        return dict(
+            (owner_id, short_title or title)
+            for owner_id, (title, short_title, is_online, publication_date, expiry_date)
+            in self.get(country_group_id).items()
+            if not published or (
+                is_online
+                and (publication_date is None or publication_date <= now)
+                and (expiry_date is None or expiry_date > now)
+            )
+        )
+
+    def invalidate(self, country_group_id):
+        '''
+        Removes the index for the given country group, so that it is rebuilt
+        from the database the next time it is needed.
+        '''
+        cache.delete(self.get_key(country_group_id))
+
+
+# A single translation index, shared through the cache.
+translations = TranslationIndex()
+
+
+@receiver(pre_save, sender='pages.Page')
+def remember_translation(sender, instance, raw=False, **kwargs):
+    # A translation can be moved to another group or page, so remember where
+    # it was in the index.
+    instance._indexed_translation = None
+    if instance.pk and instance.owner_id and not raw:
+        instance._indexed_translation = sender._base_manager.filter(
+            pk=instance.pk,
+            owner_id__isnull=False,
+            version_for_id__isnull=True,
+        ).values_list('country_group_id', 'owner_id').first()
+
+
+def invalidate_translations(*country_group_ids):
+    '''
+    Invalidates the indexes for the given country groups now and again when
+    the current transaction commits. Nothing is written to the cache until
+    the index is next read, so a rolled back save can't leave its values
+    behind.
+    '''
+    def invalidate():
+        for country_group_id in country_group_ids:
+            translations.invalidate(country_group_id)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender='pages.Page')
+def translation_saved(sender, instance, **kwargs):
+    country_group_ids = set()
+    previous = getattr(instance, '_indexed_translation', None)
+    if previous is not None:
+        country_group_ids.add(previous[0])
+    if instance.owner_id and not instance.version_for_id:
+        country_group_ids.add(instance.country_group_id)
+    if country_group_ids:
+        invalidate_translations(*country_group_ids)
+
+
+@receiver(post_delete, sender='pages.Page')
+def translation_deleted(sender, instance, **kwargs):
+    if instance.owner_id and not instance.version_for_id:
+        invalidate_translations(instance.country_group_id)
@@ -10,12 +10,30 @@ class Command(BaseCommand):
         Removes non-cannonical pages from the MPTT tree.
         Fixes Page MPTT left and right attributes.
     '''
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the pages that would be changed without changing them.',
+        )
+
     def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
         with publication_manager.select_published(False):
             pages_not_canonical = Page.objects.filter(Q(left__isnull=False) | Q(right__isnull=False), is_canonical_page=False)
             for page in pages_not_canonical:
                 print(page, f'left: {page.left}, right: {page.right}')
             print(pages_not_canonical.count(), 'non-canonical pages in the MPTT tree.')
-            pages_not_canonical.update(left=None, right=None)
-            print('Resetting MPTT attributes for canonical pages.')
-            mptt_fix()
+            if not dry_run:
+                pages_not_canonical.update(left=None, right=None)
+                print('Resetting MPTT attributes for canonical pages.')
+
+            changed_nodes, orphans = mptt_fix(dry_run=dry_run)
+            for node in changed_nodes:
+                print(node.obj, f'left: {node.old_left} -> {node.leftattr}, right: {node.old_right} -> {node.rightattr}')
+            print(len(changed_nodes), 'canonical pages with incorrect MPTT attributes.')
+
+            for page in orphans:
+                print(page, f'parent: {page.parent_id}, left: {page.left}, right: {page.right}')
+            print(len(orphans), 'canonical pages that are not under the homepage and were left alone.')
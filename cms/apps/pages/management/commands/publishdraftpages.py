@@ -1,17 +1,29 @@
+import time
+
 from django.core.management import BaseCommand
 from django.utils.timezone import now
 
-from cms.apps.pages.utils import publish_page
+from cms.apps.pages.utils import publish_pages
 from ...models import publication_manager, Page
 
 
 class Command(BaseCommand):
     '''
-        Removes non-cannonical pages from the MPTT tree.
-        Fixes Page MPTT left and right attributes.
+        Publishes every draft version of a page that is due to be published.
     '''
     def handle(self, *args, **options):
+        start = time.monotonic()
+
         with publication_manager.select_published(False):
             pages = Page.objects.filter(version_for_id__isnull=False, version_publication_date__lte=now())
-            for page in pages:
-                publish_page(page)
+            results = publish_pages(pages)
+
+        failed = 0
+        for result in results:
+            if result.error is None:
+                self.stdout.write(f'Published "{result.live_page}" in {result.duration:.3f}s')
+            else:
+                failed += 1
+                self.stderr.write(f'Failed to publish "{result.page}" after {result.duration:.3f}s: {result.error!r}')
+
+        self.stdout.write(f'Published {len(results) - failed} of {len(results)} pages in {time.monotonic() - start:.3f}s')
@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+
+from ...models import update_effective_publication
+
+
+class Command(BaseCommand):
+    '''
+        Recomputes the publication state that pages inherit from their ancestors.
+        Run this after changing pages with QuerySet.update().
+    '''
+    def handle(self, *args, **options):
+        count = update_effective_publication()
+        print(count, 'pages updated.')
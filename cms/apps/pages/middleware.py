@@ -1,16 +1,20 @@
 '''Custom middleware used by the pages application.'''
+import functools
 import re
+import threading
 
 from django.conf import settings
-from django.db.models import Q
 from django.http import Http404, HttpResponsePermanentRedirect
 from django.shortcuts import redirect
-from django.urls import resolve, is_valid_path
 from django.utils.http import escape_leading_slashes, urlencode
 from django.utils.functional import cached_property
 
+from cms.models.managers import publication_manager
+
+from .localisation import countries
 from .utils import overlay_page_obj
-from .models import Page, Country
+from .models import Page, content_registry, resolve_cached
+from .tree import page_tree, tree_cache_enabled
 from .views import PageDispatcherView
 
 if 'cms.middleware.LocalisationMiddleware' in settings.MIDDLEWARE:
@@ -27,6 +31,36 @@ def get_client_ip(request):
     return ip
 
 
+_geoip_readers = {}
+_geoip_lock = threading.Lock()
+
+
+def get_geoip(path=None):
+    '''
+    Returns a reader for the GeoIP2 database at the given path. The database
+    is opened once per process, memory mapped, and shared between threads.
+    '''
+    reader = _geoip_readers.get(path)
+    if reader is None:
+        with _geoip_lock:
+            reader = _geoip_readers.get(path)
+            if reader is None:
+                reader = GeoIP2(path=path, cache=GeoIP2.MODE_MMAP)
+                _geoip_readers[path] = reader
+    return reader
+
+
+@functools.lru_cache(maxsize=getattr(settings, 'LOCALISATION_GEOIP_CACHE_SIZE', 10000))
+def get_ip_country_code(ip, geoip_path=None):
+    '''Returns the country code for the given IP address, or an empty string.'''
+    try:
+        return get_geoip(geoip_path).country(ip).get('country_code') or ''
+    except AddressNotFoundError:
+        # If there's no county found for that IP, just don't look for a country
+        # and go with the default
+        return ''
+
+
 class RequestPageManager:
 
     '''Handles loading page objects.'''
@@ -36,6 +70,7 @@ class RequestPageManager:
         self._request = request
         self._path = self._request.path
         self._path_info = self._request.path_info
+        self._alternate_versions = {}
 
     @cached_property
     def country(self):
@@ -50,30 +85,56 @@ class RequestPageManager:
 
         return None
 
-    def alternate_page_version(self, page):
+    def get_alternate_versions(self, pages):
+        '''
+        Returns the alternate versions of the given pages for the current
+        country, by the ID of the page they belong to. Pages that haven't been
+        looked up before are fetched with a single query.
+        '''
         # Save ourselves a DB query if we are not using localisation.
         if not self.country:
-            return page
+            return {}
 
-        try:
-            # See if the page has any alternate versions for the current country
-            alternate_version = Page.objects.get(
+        page_ids = [page.pk for page in pages]
+        missing_ids = [page_id for page_id in page_ids if page_id not in self._alternate_versions]
+        if missing_ids:
+            self._alternate_versions.update(dict.fromkeys(missing_ids))
+            for alternate_version in Page.objects.filter(
                 is_canonical_page=False,
-                owner=page,
-                country_group=self.request_country_group()
-            )
+                owner_id__in=missing_ids,
+                country_group=self.request_country_group(),
+            ):
+                self._alternate_versions[alternate_version.owner_id] = alternate_version
+
+        return dict(
+            (page_id, self._alternate_versions[page_id])
+            for page_id in page_ids
+            if self._alternate_versions[page_id] is not None
+        )
+
+    def alternate_page_version(self, page):
+        '''
+        Returns the alternate version of the given page for the current country,
+        or the page itself if there isn't one. The alternate versions of every
+        breadcrumb are looked up together.
+        '''
+        pages = self.breadcrumbs if self.country else []
+        if page.pk not in set(breadcrumb.pk for breadcrumb in pages):
+            pages = pages + [page]
+        return self.get_alternate_versions(pages).get(page.pk, page)
 
-            return alternate_version
-        except Page.DoesNotExist:
-            return page
+    @cached_property
+    def tree(self):
+        '''The page tree snapshot for this request, or None if it is disabled.'''
+        if not tree_cache_enabled():
+            return None
+        return page_tree.get()
 
     @cached_property
     def homepage(self):
         '''Returns the site homepage.'''
-        try:
-            return Page.objects.get_homepage()
-        except Page.DoesNotExist:
-            return None
+        # The homepage is always the first breadcrumb.
+        return self.breadcrumbs[0] if self.breadcrumbs else None
 
     @cached_property
     def navigation(self):
@@ -89,19 +150,25 @@ class RequestPageManager:
         '''The breadcrumbs for the current request.'''
         breadcrumbs = []
         slugs = self._path_info.strip('/').split('/')
-        slugs.reverse()
-
-        def do_breadcrumbs(page):
-            breadcrumbs.append(page)
-            if slugs:
-                slug = slugs.pop()
-                for child in page.children:
-                    if child.slug == slug:
-                        do_breadcrumbs(child)
-                        break
-        if self.homepage:
-            do_breadcrumbs(self.homepage)
-        return breadcrumbs
+
+        if self.tree is not None:
+            entries = self.tree.resolve_path(
+                slugs,
+                published=publication_manager.select_published_active(),
+            )
+            # Fetch the full pages for the whole chain at once.
+            pages = Page._base_manager.in_bulk([entry.id for entry in entries])
+            for entry in entries:
+                page = pages.get(entry.id)
+                if page is None:
+                    break
+                page.is_canonical_page = True
+                if breadcrumbs:
+                    page.parent = breadcrumbs[-1]
+                breadcrumbs.append(page)
+            return breadcrumbs
+
+        return Page.objects.get_path_pages(slugs)
 
     @cached_property
     def section(self):
@@ -130,6 +197,43 @@ class RequestPageManager:
         except IndexError:
             return None
 
+    @cached_property
+    def inherited_flags(self):
+        '''
+        The flags that the current page inherits from its ancestors, worked out
+        from the breadcrumbs in one pass.
+        '''
+        flags = {
+            'requires_authentication': False,
+            'hide_from_anonymous': False,
+            'in_navigation': True,
+        }
+        pages = list(self.breadcrumbs)
+        if self.current is not None:
+            pages.append(self.current)
+        for index, page in enumerate(pages):
+            flags['requires_authentication'] = flags['requires_authentication'] or page.requires_authentication
+            flags['hide_from_anonymous'] = flags['hide_from_anonymous'] or page.hide_from_anonymous
+            # The homepage is the root of the navigation, so it doesn't count.
+            if index > 0:
+                flags['in_navigation'] = flags['in_navigation'] and page.in_navigation
+        return flags
+
+    @property
+    def auth_required(self):
+        '''Whether the current page, or any of its ancestors, requires authentication.'''
+        return self.inherited_flags['requires_authentication']
+
+    @property
+    def hidden_from_anonymous(self):
+        '''Whether the current page, or any of its ancestors, is hidden from anonymous users.'''
+        return self.inherited_flags['hide_from_anonymous']
+
+    @property
+    def in_navigation(self):
+        '''Whether the current page and all of its ancestors are in the navigation.'''
+        return self.inherited_flags['in_navigation']
+
     @cached_property
     def is_exact(self):
         '''Whether the current page exactly matches the request URL.'''
@@ -171,14 +275,15 @@ class PageMiddleware:
                     script_name = page.get_absolute_url()[:-1]
                     path_info = request.path[len(script_name):]
 
-                    urlconf = getattr(page.content, 'urlconf', None) if hasattr(page, 'content') else None
+                    urlconf = content_registry.get(page.content_type_id).urlconf
 
                     # Check if the URL with a slash appended is resolved by the current page's urlconf
-                    if (is_valid_path(path_info, urlconf)
-                            or not is_valid_path(f'{path_info}/', urlconf)):
+                    if (urlconf is None
+                            or resolve_cached(path_info, urlconf) is not None
+                            or resolve_cached(f'{path_info}/', urlconf) is None):
                         # Check if the URL with a slash appended resolves for something other than a page
-                        match = resolve(f'{path_info}/', getattr(request, 'urlconf', None))
-                        if getattr(match.func, 'view_class', None) is PageDispatcherView:
+                        match = resolve_cached(f'{path_info}/', getattr(request, 'urlconf', None))
+                        if match is None or getattr(match.func, 'view_class', None) is PageDispatcherView:
                             # Couldn't find any view that would be resolved for this URL
                             # No point redirecting to a URL that will 404
                             return None
@@ -206,41 +311,19 @@ class LocalisationMiddleware:
         request.country = None
 
         # Check to see if we have a country in the URL
-        country_match = re.match('/([a-z]{2})/|\b', request.path)
-        if country_match:
-
-            # Try and get a country from the database
-            try:
-                request.country = Country.objects.get(
-                    code__iexact=str(country_match.group(1))
-                )
-
-                request.path = request.path.replace('/{}'.format(
-                    country_match.group(1)
-                ), '', 1)
-                request.path_info = request.path
-
-            except Country.DoesNotExist:
-                pass
+        country, path = countries.split_path(request.path)
+        if country is not None:
+            request.country = country
+            request.path = path
+            request.path_info = request.path
 
         # If we don't have a country at this point, we need to do some ip
         # checking or assumption
         if request.country is None:
             # Get the Geo location of the requests IP
-            geo_ip = GeoIP2(path=geoip_path)
-
-            try:
-                country_geo_ip = geo_ip.country(get_client_ip(request))
-            except AddressNotFoundError:
-                # If there's no county found for that IP, just don't look for a country
-                # and go with the default
-                country_geo_ip = {}
-
-            code = country_geo_ip.get('country_code', '')
+            code = get_ip_country_code(get_client_ip(request), geoip_path)
 
-            request.country = Country.objects.filter(
-                Q(code__iexact=code) | Q(default=True)
-            ).order_by('-default').first()
+            request.country = countries.get_or_default(code)
 
             if request.country:
                 path = f'/{request.country.code.lower()}{request.path}'
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+def populate_url_paths(apps, schema_editor):
+    Page = apps.get_model('pages', 'Page')
+    db_alias = schema_editor.connection.alias
+    pages = dict(
+        (page.pk, page)
+        for page
+        in Page.objects.using(db_alias).only('id', 'parent_id', 'slug', 'url_path')
+    )
+
+    def get_url_path(page):
+        if page.url_path is None:
+            parent = pages.get(page.parent_id)
+            if parent is None:
+                page.url_path = '/'
+            else:
+                page.url_path = get_url_path(parent) + page.slug + '/'
+        return page.url_path
+
+    for page in pages.values():
+        page.url_path = None
+
+    for page in pages.values():
+        get_url_path(page)
+
+    Page.objects.using(db_alias).bulk_update(pages.values(), ['url_path'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0020_auto_20210520_1043'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='url_path',
+            field=models.CharField(db_index=True, editable=False, help_text='The URL of this page, relative to the script prefix. This is maintained automatically when the page is saved.', max_length=1000, null=True),
+        ),
+        migrations.RunPython(
+            populate_url_paths,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations, models
+
+
+def populate_effective_publication(apps, schema_editor):
+    Page = apps.get_model('pages', 'Page')
+    db_alias = schema_editor.connection.alias
+    pages = list(Page.objects.using(db_alias).only(
+        'id',
+        'parent_id',
+        'owner_id',
+        'version_for_id',
+        'is_online',
+        'publication_date',
+        'expiry_date',
+    ).order_by('left'))
+
+    inherited = {}
+    for page in pages:
+        if page.owner_id or page.version_for_id:
+            parent_state = (True, None, None)
+        else:
+            parent_state = inherited.get(page.parent_id, (True, None, None))
+        state = (
+            parent_state[0] and page.is_online,
+            max(filter(None, (parent_state[1], page.publication_date)), default=None),
+            min(filter(None, (parent_state[2], page.expiry_date)), default=None),
+        )
+        if not (page.owner_id or page.version_for_id):
+            inherited[page.pk] = state
+        page.effective_online, page.effective_publication_date, page.effective_expiry_date = state
+
+    Page.objects.using(db_alias).bulk_update(
+        pages,
+        ['effective_online', 'effective_publication_date', 'effective_expiry_date'],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0021_page_url_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='effective_online',
+            field=models.BooleanField(db_index=True, default=True, editable=False, help_text='Whether this page and all of its ancestors are online.'),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='effective_publication_date',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='The latest publication date of this page and its ancestors.', null=True),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='effective_expiry_date',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, help_text='The earliest expiry date of this page and its ancestors.', null=True),
+        ),
+        migrations.RunPython(
+            populate_effective_publication,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -1,9 +1,15 @@
 '''Core models used by the CMS.'''
+import functools
+from collections import namedtuple
+
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django import urls
 from django.db import connection, models, transaction
-from django.db.models import Case, Exists, ExpressionWrapper, F, Func, OuterRef, Q, Value, When
+from django.db.models import Case, Exists, ExpressionWrapper, F, Func, Max, OuterRef, Q, Value, When
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
 from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
@@ -12,14 +18,50 @@ from django.utils.functional import cached_property
 from reversion.models import Version
 
 from cms import sitemaps
+from cms.apps.pages.tree import page_tree, tree_cache_enabled
 from cms.models import OnlineBaseManager, PageBase, PageBaseSearchAdapter
 from cms.models.managers import publication_manager
 
 
+class PageQuerySet(models.QuerySet):
+
+    '''QuerySet for Page objects.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefetch_content = False
+
+    def with_content(self):
+        '''
+        Fetches the content of the pages with a single query for each type of
+        content, rather than one query per page.
+        '''
+        clone = self._chain()
+        clone._prefetch_content = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._prefetch_content = self._prefetch_content
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._prefetch_content and not fetched:
+            prefetch_page_content([obj for obj in self._result_cache if isinstance(obj, Page)])
+
+
 class PageManager(OnlineBaseManager):
 
     '''Manager for Page objects.'''
 
+    _queryset_class = PageQuerySet
+
+    def with_content(self):
+        '''Returns a queryset that fetches the content of its pages in bulk.'''
+        return self.get_queryset().with_content()
+
     def get_queryset(self):
         queryset = super().get_queryset().annotate(is_canonical_page=ExpressionWrapper(
             Q(owner_id__isnull=True) & Q(version_for_id__isnull=True), output_field=models.BooleanField()
@@ -38,6 +80,15 @@ class PageManager(OnlineBaseManager):
         )
         queryset = queryset.filter(Q(expiry_date=None) | Q(expiry_date__gt=now))
 
+        if getattr(settings, 'PAGES_EFFECTIVE_PUBLICATION', False):
+            # Use the publication state inherited from the ancestors, which is
+            # kept up to date when pages are saved.
+            return queryset.filter(
+                Q(effective_online=True),
+                Q(effective_publication_date=None) | Q(effective_publication_date__lte=now),
+                Q(effective_expiry_date=None) | Q(effective_expiry_date__gt=now),
+            )
+
         # Perform parent ordering.
         offline_ancestors = self._queryset_class(model=self.model, using=self._db, hints=self._hints).filter(
             Q(version_for_id__isnull=True),
@@ -53,11 +104,155 @@ class PageManager(OnlineBaseManager):
         '''Returns the site homepage.'''
         return self.get(parent=None, is_canonical_page=True)
 
+    def get_path_pages(self, slugs):
+        '''
+        Returns the chain of pages matching the given list of slugs, starting
+        at the homepage and stopping at the deepest matching page.
+
+        Every page in the chain is fetched in a single query, and each page's
+        parent is set to the page before it.
+
+        Pages are looked up by their stored url_path, so slugs must be
+        changed by saving the page rather than with QuerySet.update().
+        '''
+        url_paths = ['/']
+        for slug in slugs:
+            url_paths.append(f'{url_paths[-1]}{slug}/')
+
+        pages = dict(
+            (page.url_path, page)
+            for page
+            in self.filter(url_path__in=url_paths, is_canonical_page=True)
+        )
+
+        chain = []
+        for url_path in url_paths:
+            page = pages.get(url_path)
+            if page is None:
+                break
+            if chain:
+                page.parent = chain[-1]
+            chain.append(page)
+        return chain
+
+    def prefetch_children(self, pages, depth=None):
+        '''
+        Fetches the descendants of the given pages, up to `depth` levels below
+        them, with a single query, and fills in the `children` of each page so
+        that walking the tree below them costs no further queries.
+        '''
+        if depth is not None and depth < 1:
+            return
+
+        roots = dict(
+            (page.pk, page)
+            for page in pages
+            if page.left is not None and page.right is not None and 'children' not in page.__dict__
+        )
+        if not roots:
+            return
+
+        # The snapshot already knows the children - don't query for them.
+        if tree_cache_enabled() and page_tree.get() is not None:
+            return
+
+        ranges = Q()
+        for page in roots.values():
+            ranges |= Q(left__gt=page.left, right__lt=page.right)
+
+        pages_by_id = dict(roots)
+        depths = dict((page_id, 0) for page_id in roots)
+        children = dict((page_id, []) for page_id in roots)
+
+        # Parents always come before their children in tree order.
+        for page in self.filter(ranges, is_canonical_page=True).order_by('left'):
+            parent = pages_by_id.get(page.parent_id)
+            if parent is None or parent.pk not in children:
+                continue
+            page = pages_by_id.setdefault(page.pk, page)
+            page.parent = parent
+            children[parent.pk].append(page)
+            if page.pk not in depths:
+                depths[page.pk] = depths[parent.pk] + 1
+                if depth is None or depths[page.pk] < depth:
+                    children[page.pk] = []
+
+        for page_id, child_pages in children.items():
+            pages_by_id[page_id].__dict__['children'] = child_pages
+
 
 not_in_tree_q = Q(left__isnull=True) & Q(right__isnull=True)
 in_tree_q = Q(left__isnull=False) & Q(right__isnull=False)
 
 
+def get_page_tree_gap():
+    '''
+    Returns the number of unused values left at the end of each page's range
+    when the tree is renumbered. Zero means the tree is densely numbered.
+    '''
+    return getattr(settings, 'PAGES_TREE_GAP', 0)
+
+
+# The key of the Postgres advisory lock that serialises changes to the page tree.
+PAGE_TREE_LOCK_ID = 0x70616765
+
+
+def lock_page_tree():
+    '''
+    Serialises changes to the page tree until the end of the current
+    transaction. Unlike locking the pages table, this does not block readers
+    or changes to pages that leave the tree alone.
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PAGE_TREE_LOCK_ID])
+
+
+def shift_page_tree(start, delta):
+    '''
+    Adds delta to every left and right value from start onwards, in a single
+    UPDATE. Pages that enclose start only have their right value moved.
+    '''
+    Page._base_manager.filter(right__gte=start).update(
+        left=Case(
+            When(left__gte=start, then=F('left') + delta),
+            default=F('left'),
+        ),
+        right=F('right') + delta,
+    )
+
+
+def move_page_branch(left, right, target):
+    '''
+    Moves the branch between left and right so that it sits immediately before
+    the position target, closing the gap it leaves behind. Only the pages
+    between the branch and the target are touched, in a single UPDATE.
+    '''
+    if left < target <= right:
+        raise ValueError('A page cannot be moved inside its own branch.')
+
+    branch_width = right - left + 1
+    if target > right:
+        low, high = left, target - 1
+        branch_offset, between_offset = target - right - 1, -branch_width
+    else:
+        low, high = target, right
+        branch_offset, between_offset = target - left, branch_width
+
+    def move(field):
+        return Case(
+            When(**{f'{field}__range': (left, right)}, then=F(field) + branch_offset),
+            When(**{f'{field}__range': (low, high)}, then=F(field) + between_offset),
+            default=F(field),
+        )
+
+    Page._base_manager.filter(
+        Q(left__range=(low, high)) | Q(right__range=(low, high)),
+    ).update(
+        left=move('left'),
+        right=move('right'),
+    )
+
+
 class Page(PageBase):
 
     '''A page within the site.'''
@@ -128,13 +323,33 @@ class Page(PageBase):
         verbose_name='publish on',
     )
 
+    # Rebuilt by save(). Slugs changed with QuerySet.update() leave this and
+    # the url_path of every descendant out of date, until the page is saved.
+    url_path = models.CharField(
+        max_length=1000,
+        editable=False,
+        db_index=True,
+        null=True,
+        help_text='The URL of this page, relative to the script prefix. This is '
+                  'maintained automatically when the page is saved.',
+    )
+
     @cached_property
     def children(self):
         '''The child pages for this page.'''
         children = []
         page = self.canonical_version
-        if page.right - page.left > 1:  # Optimization - don't fetch children
-            #  we know aren't there!
+        tree = page_tree.get() if tree_cache_enabled() else None
+        if tree is not None and page.pk in tree:
+            # The snapshot already knows the children - don't query for them.
+            for entry in tree.get_children(page.pk, published=publication_manager.select_published_active()):
+                children.append(tree.get_page(entry, parent=page))
+            return children
+        # Optimization - don't fetch children we know aren't there! A child
+        # needs at least two values inside its parent's range. A leaf can be
+        # wider than that when PAGES_TREE_GAP is set, but so can a page whose
+        # children were put into its gap, so the width can't say any more.
+        if page.right - page.left > 2:
             for child in page.child_set.filter(is_canonical_page=True):
                 child.parent = page
                 children.append(child)
@@ -163,6 +378,29 @@ class Page(PageBase):
                   'Leave this blank to never expire this page.',
     )
 
+    effective_online = models.BooleanField(
+        default=True,
+        editable=False,
+        db_index=True,
+        help_text='Whether this page and all of its ancestors are online.',
+    )
+
+    effective_publication_date = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        db_index=True,
+        help_text='The latest publication date of this page and its ancestors.',
+    )
+
+    effective_expiry_date = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        db_index=True,
+        help_text='The earliest expiry date of this page and its ancestors.',
+    )
+
     # Navigation fields.
 
     in_navigation = models.BooleanField(
@@ -193,15 +431,25 @@ class Page(PageBase):
     )
 
     def auth_required(self):
-        if self.requires_authentication or not self.parent:
-            return self.requires_authentication
-        return self.parent.auth_required()
+        '''Returns True if this page or any of its ancestors requires authentication.'''
+        if self.requires_authentication:
+            return True
+        tree = page_tree.get() if tree_cache_enabled() else None
+        if tree is not None and self.parent_id in tree:
+            # The snapshot already knows the ancestors - don't query for them.
+            ancestors = tree.get_ancestors(self.parent_id) + [tree.get(self.parent_id)]
+            return any(entry.requires_authentication for entry in ancestors)
+        page = self
+        while page.parent_id:
+            page = page.parent
+            if page.requires_authentication:
+                return True
+        return False
 
     @cached_property
     def content(self):
         '''The associated content model for this page.'''
-        content_cls = ContentType.objects.get_for_id(
-            self.content_type_id).model_class()
+        content_cls = content_registry.get(self.content_type_id).model
         content = content_cls._default_manager.get(page=self)
         content.page = self
         return content
@@ -212,9 +460,11 @@ class Page(PageBase):
             args = ()
         if kwargs is None:
             kwargs = {}
-        urlconf = ContentType.objects.get_for_id(
-            self.content_type_id
-        ).model_class().urlconf
+        urlconf = content_registry.get(self.content_type_id).urlconf
+        if urlconf is None:
+            # The content model no longer exists, so don't fall back to the
+            # root urlconf.
+            raise urls.NoReverseMatch(f'The content type of "{self}" has no urlconf.')
 
         return self.get_absolute_url().rstrip('/') + urls.reverse(
             view_func,
@@ -227,12 +477,51 @@ class Page(PageBase):
 
     def get_absolute_url(self):
         '''Generates the absolute url of the page.'''
+        if self.url_path is not None:
+            return urls.get_script_prefix() + self.url_path[1:]
 
         if not self.parent:
             return urls.get_script_prefix()
 
         return self.parent.get_absolute_url() + self.slug + '/'
 
+    def _get_url_path(self, parent_url_path=None):
+        '''Generates the URL path of the page from its parent's.'''
+        if not self.parent_id:
+            return '/'
+
+        if parent_url_path is None:
+            parent_url_path = self.parent.url_path or self.parent._get_url_path()
+
+        return parent_url_path + self.slug + '/'
+
+    def _update_url_path(self):
+        '''
+        Sets the URL path of this page from the stored URL path of its parent,
+        and returns the URL path it had before.
+        '''
+        url_paths = dict(
+            Page._base_manager.filter(
+                pk__in=[pk for pk in (self.pk, self.parent_id) if pk is not None],
+            ).values_list('pk', 'url_path')
+        )
+        self.url_path = self._get_url_path(url_paths.get(self.parent_id))
+        return url_paths.get(self.pk)
+
+    def _rewrite_descendant_url_paths(self, old_url_path):
+        '''Rewrites the URL paths of every page below this one.'''
+        Page._base_manager.filter(
+            url_path__startswith=old_url_path,
+        ).exclude(
+            Q(pk=self.pk) | Q(owner_id=self.pk) | Q(version_for_id=self.pk),
+        ).update(
+            url_path=Concat(
+                Value(self.url_path),
+                Substr('url_path', len(old_url_path) + 1),
+                output_field=models.CharField(),
+            ),
+        )
+
     # Tree management.
 
     @property
@@ -241,123 +530,156 @@ class Page(PageBase):
 
     def _excise_branch(self):
         '''Excises this whole branch from the tree.'''
-        branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left=F('left') - branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right=F('right') - branch_width,
-        )
+        shift_page_tree(self.left, -self._branch_width)
 
     def _insert_branch(self):
         '''Inserts this whole branch into the tree.'''
+        shift_page_tree(self.left, self._branch_width)
+
+    @staticmethod
+    def _get_free_range(parent_id):
+        '''
+        Returns the first and last unused values between the last child of the
+        given page and its right value.
+        '''
+        parent_left, parent_right = Page._base_manager.filter(pk=parent_id).values_list('left', 'right').get()
+        last_right = Page._base_manager.filter(
+            parent_id=parent_id,
+            owner_id__isnull=True,
+            version_for_id__isnull=True,
+        ).aggregate(Max('right'))['right__max'] or parent_left
+        return last_right + 1, parent_right - 1
+
+    def _insert_sparse(self, gap):
+        '''
+        Puts this page into an unused range at the end of its parent, writing
+        no other rows. Returns False if the parent has no room for it.
+        '''
+        first, last = self._get_free_range(self.parent_id)
+        free = last - first + 1
+        if free < 2:
+            return False
+        # Keep most of the free space for later siblings.
+        self.left = first
+        self.right = first + 1 + min(gap, (free - 2) // 4)
+        return True
+
+    def _move_sparse(self):
+        '''
+        Moves this branch into an unused range at the end of its new parent,
+        writing only the rows in the branch. Returns False if the parent has
+        no room for it.
+        '''
+        first, last = self._get_free_range(self.parent_id)
         branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left=F('left') + branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right=F('right') + branch_width,
+        if last - first + 1 < branch_width or self.left <= first <= self.right:
+            return False
+        offset = first - self.left
+        Page._base_manager.filter(left__gte=self.left, right__lte=self.right).update(
+            left=F('left') + offset,
+            right=F('right') + offset,
         )
+        self.left += offset
+        self.right += offset
+        return True
+
+    @staticmethod
+    def _rebalance_tree(gap):
+        '''Renumbers the whole tree to restore the gaps between pages.'''
+        from .utils import mptt_fix
+        mptt_fix(gap)
 
     @transaction.atomic
     def save(self, *args, **kwargs):
         '''Saves the page.'''
 
         if self._is_canonical_page:
-            with connection.cursor() as cursor:
-                cursor.execute('LOCK TABLE {} IN ROW SHARE MODE'.format(Page._meta.db_table))
-
-                # Lock entire table.
-                existing_pages = dict(
-                    (page['id'], page)
-                    for page
-                    in Page.objects.filter(
-                        is_canonical_page=True
-                    ).select_for_update().values(
-                        'id',
-                        'parent_id',
-                        'left',
-                        'right'
-                    )
-                )
-
-                if self.left is None or self.right is None:
-                    # This page is being inserted.
-                    if existing_pages:
-                        if not self.parent_id:
-                            # There is no parent - we're updating the homepage.
-                            # Set the parent to be the homepage by default
-                            self.parent_id = Page.objects.get_homepage().pk
-
-                        parent_right = existing_pages[self.parent_id]['right']
+            lock_page_tree()
+
+            # Read the stored position of this page now that the tree is locked.
+            current = None
+            if self.pk:
+                current = Page._base_manager.filter(pk=self.pk).values_list('parent_id', 'left', 'right').first()
+
+            if self.left is None or self.right is None or current is None or current[1] is None:
+                # This page is being inserted.
+                if not self.parent_id:
+                    # There is no parent - we're updating the homepage.
+                    # Set the parent to be the homepage by default
+                    self.parent_id = Page._base_manager.filter(
+                        parent=None,
+                        owner_id__isnull=True,
+                        version_for_id__isnull=True,
+                    ).values_list('pk', flat=True).first()
+
+                if self.parent_id:
+                    gap = get_page_tree_gap()
+                    # Try to put the page into a gap in the numbering.
+                    inserted = gap and self._insert_sparse(gap)
+                    if gap and not inserted:
+                        # The parent has run out of room, so renumber the tree.
+                        self._rebalance_tree(gap)
+                        inserted = self._insert_sparse(gap)
+                    if not inserted:
+                        parent_right = Page._base_manager.filter(pk=self.parent_id).values_list('right', flat=True).get()
                         # Set the model left and right.
                         self.left = parent_right
                         self.right = self.left + 1
-                        # Update the whole tree structure.
+                        # Make room for it in the tree.
                         self._insert_branch()
-                    else:
-                        # This is the first page to be created, ever!
-                        self.left = 1
-                        self.right = 2
                 else:
-                    # This is an update.
-                    if self.id not in existing_pages:
-                        old_parent_id = -1
+                    # This is the first page to be created, ever!
+                    self.left = 1
+                    self.right = 2
+            else:
+                old_parent_id, self.left, self.right = current
+
+                if old_parent_id != self.parent_id and self.parent_id and get_page_tree_gap() and self._move_sparse():
+                    # The branch went into a gap in the numbering.
+                    pass
+                elif old_parent_id != self.parent_id and self.parent_id:
+                    # The page has moved - make it the last child of its new parent.
+                    parent_right = Page._base_manager.filter(pk=self.parent_id).values_list('right', flat=True).get()
+                    branch_width = self._branch_width
+                    move_page_branch(self.left, self.right, parent_right)
+                    if parent_right > self.right:
+                        self.left = parent_right - branch_width
                     else:
-                        old_parent_id = existing_pages[self.id]['parent_id']
-
-                    if old_parent_id != self.parent_id:
-                        # The page has moved.
-                        branch_width = self.right - self.left + 1
-                        # Disconnect child branch.
-                        if branch_width > 2:
-                            Page.objects.filter(
-                                left__gt=self.left,
-                                right__lt=self.right
-                            ).update(
-                                left=F('left') * -1,
-                                right=F('right') * -1,
-                            )
-                        self._excise_branch()
-                        # Store old left and right values.
-                        old_left = self.left
-                        old_right = self.right
-                        # Put self into the tree.
-                        if self.parent_id:
-                            parent_right = existing_pages[self.parent_id]['right']
-                            if parent_right > self.right:
-                                parent_right -= self._branch_width
-                            self.left = parent_right
-                            self.right = self.left + branch_width - 1
-                            self._insert_branch()
-
-                            # Put all children back into the tree.
-                            if branch_width > 2:
-                                child_offset = self.left - old_left
-                                Page.objects.filter(
-                                    left__lt=-old_left,
-                                    right__gt=-old_right
-                                ).update(
-                                    left=(F('left') - child_offset) * -1,
-                                    right=(F('right') - child_offset) * -1,
-                                )
+                        self.left = parent_right
+                    self.right = self.left + branch_width - 1
+
+        if not self._is_canonical_page:
+            # Translations and versions are not in the tree, so inherit nothing.
+            self.effective_online = self.is_online
+            self.effective_publication_date = self.publication_date
+            self.effective_expiry_date = self.expiry_date
+
+        old_url_path = self._update_url_path()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'url_path'}
 
         # Now actually save it!
         super().save(*args, **kwargs)
 
+        # Keep the URLs of the whole branch in step with this page.
+        if self._is_canonical_page and old_url_path and old_url_path != self.url_path:
+            self._rewrite_descendant_url_paths(old_url_path)
+
+        if self._is_canonical_page:
+            update_effective_publication(self)
+
     @transaction.atomic
     def delete(self, *args, **kwargs):
         '''Deletes the page.'''
         if self._is_canonical_page:
-            list(Page.objects.filter(is_canonical_page=True).select_for_update().values_list(
-                'left',
-                'right',
-            ))  #
-            # Lock entire
-            #  table.
+            lock_page_tree()
+            current = Page._base_manager.filter(pk=self.pk).values_list('left', 'right').first()
+            if current:
+                self.left, self.right = current
             super().delete(*args, **kwargs)
-            # Update the entire tree.
-            self._excise_branch()
+            # Close the gap left by the branch, unless gaps are wanted.
+            if not get_page_tree_gap():
+                self._excise_branch()
         else:
             super().delete(*args, **kwargs)
 
@@ -498,14 +820,176 @@ class PageSearchAdapter(PageBaseSearchAdapter):
         return qs
 
 
+def prefetch_page_content(pages):
+    '''
+    Fetches the content of the given pages with a single query for each type
+    of content, and attaches it to the `content` of each page.
+    '''
+    pages_by_type = {}
+    for page in pages:
+        if 'content' not in page.__dict__:
+            pages_by_type.setdefault(page.content_type_id, {})[page.pk] = page
+
+    for content_type_id, type_pages in pages_by_type.items():
+        content_cls = content_registry.get(content_type_id).model
+        for content in content_cls._default_manager.filter(page__in=list(type_pages)):
+            page = type_pages[content.page_id]
+            content.page = page
+            page.__dict__['content'] = content
+
+
 # Base content class.
 
 def get_registered_content():
     '''Returns a list of all registered content objects.'''
-    return [
-        model for model in apps.get_models()
-        if issubclass(model, ContentBase) and not model._meta.abstract
-    ]
+    return list(content_registry.models)
+
+
+ContentTypeEntry = namedtuple('ContentTypeEntry', ['model', 'urlconf', 'template_names', 'robots_index', 'classifier'])
+
+
+class ContentRegistry:
+
+    '''
+    The registered content models, and what pages need to know about each of
+    them by content type ID. Each entry is worked out the first time it is
+    needed, and everything is forgotten whenever a model class is created.
+    '''
+
+    def __init__(self):
+        '''Initializes the ContentRegistry.'''
+        self._models = None
+        self._entries = {}
+
+    @property
+    def models(self):
+        '''The registered content models.'''
+        if self._models is None:
+            self._models = tuple(
+                model for model in apps.get_models()
+                if issubclass(model, ContentBase) and not model._meta.abstract
+            )
+        return self._models
+
+    def get(self, content_type_id):
+        '''
+        Returns the entry for the given content type ID. If the content type's
+        model no longer exists, the entry's model and urlconf are None.
+        '''
+        entry = self._entries.get(content_type_id)
+        if entry is None:
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            template_names = ()
+            if model is not None:
+                params = {
+                    'model_name': model.__name__.lower(),
+                    'app_label': model._meta.app_label,
+                }
+                template_names = (
+                    '{app_label}/{model_name}.html'.format(**params),
+                    '{app_label}/base.html'.format(**params),
+                    'base.html',
+                )
+            entry = ContentTypeEntry(
+                model=model,
+                urlconf=getattr(model, 'urlconf', None),
+                template_names=template_names,
+                robots_index=getattr(model, 'robots_index', True),
+                classifier=getattr(model, 'classifier', None),
+            )
+            self._entries[content_type_id] = entry
+        return entry
+
+    def get_indexable_content_types(self):
+        '''Returns the content types of the models that search engines should index.'''
+        return [
+            ContentType.objects.get_for_model(model)
+            for model in self.models
+            if model.robots_index
+        ]
+
+    def clear(self):
+        '''Forgets all the registered content models.'''
+        self._models = None
+        self._entries = {}
+
+
+# A single content registry.
+content_registry = ContentRegistry()
+
+
+@functools.lru_cache(maxsize=getattr(settings, 'PAGES_RESOLVER_CACHE_SIZE', 1024))
+def _resolve_cached(resolver, path):
+    try:
+        return resolver.resolve(path)
+    except urls.Resolver404:
+        return None
+
+
+def resolve_cached(path, urlconf=None):
+    '''
+    Resolves the given path against the given urlconf, or the current urlconf,
+    remembering the most recent results. Returns None if the path doesn't
+    resolve.
+    '''
+    if urlconf is None:
+        urlconf = urls.get_urlconf()
+    # Keying on the resolver means that results are forgotten when Django's URL
+    # caches are cleared.
+    return _resolve_cached(urls.get_resolver(urlconf), path)
+
+
+EFFECTIVE_PUBLICATION_FIELDS = ['effective_online', 'effective_publication_date', 'effective_expiry_date']
+
+
+def update_effective_publication(page=None):
+    '''
+    Recomputes the publication state that the given page and every page below
+    it inherit from their ancestors, or that of the whole page tree if no page
+    is given. Returns the number of pages that changed.
+    '''
+    queryset = Page._base_manager.filter(
+        owner_id__isnull=True,
+        version_for_id__isnull=True,
+    )
+    inherited = {}
+
+    if page is not None:
+        queryset = queryset.filter(left__gte=page.left, right__lte=page.right)
+        if page.parent_id:
+            inherited[page.parent_id] = Page._base_manager.filter(
+                pk=page.parent_id,
+            ).values_list(*EFFECTIVE_PUBLICATION_FIELDS).get()
+
+    changed_pages = []
+    queryset = queryset.only(
+        'id',
+        'parent_id',
+        'is_online',
+        'publication_date',
+        'expiry_date',
+        *EFFECTIVE_PUBLICATION_FIELDS
+    ).order_by('left')
+
+    # Parents always come before their children in tree order.
+    for obj in queryset:
+        parent_online, parent_publication_date, parent_expiry_date = inherited.get(obj.parent_id, (True, None, None))
+        state = (
+            parent_online and obj.is_online,
+            max(filter(None, (parent_publication_date, obj.publication_date)), default=None),
+            min(filter(None, (parent_expiry_date, obj.expiry_date)), default=None),
+        )
+        inherited[obj.pk] = state
+
+        if state != (obj.effective_online, obj.effective_publication_date, obj.effective_expiry_date):
+            obj.effective_online, obj.effective_publication_date, obj.effective_expiry_date = state
+            changed_pages.append(obj)
+
+        if page is not None and obj.pk == page.pk:
+            page.effective_online, page.effective_publication_date, page.effective_expiry_date = state
+
+    Page._base_manager.bulk_update(changed_pages, EFFECTIVE_PUBLICATION_FIELDS, batch_size=1000)
+    return len(changed_pages)
 
 
 def filter_indexable_pages(queryset):
@@ -515,12 +999,7 @@ def filter_indexable_pages(queryset):
     '''
     return queryset.filter(
         robots_index=True,
-        content_type__in=[
-            ContentType.objects.get_for_model(content_model)
-            for content_model
-            in get_registered_content()
-            if content_model.robots_index
-        ]
+        content_type__in=content_registry.get_indexable_content_types(),
     )
 
 
@@ -580,6 +1059,14 @@ class ContentBase(models.Model):
         ])
 
 
+@receiver(class_prepared)
+def model_class_prepared(sender, **kwargs):
+    # Only new content models can change what the registry holds. Any model
+    # prepared before this point can't be one.
+    if issubclass(sender, ContentBase):
+        content_registry.clear()
+
+
 class Country(models.Model):
     name = models.CharField(
         max_length=256,
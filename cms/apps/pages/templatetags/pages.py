@@ -1,57 +1,260 @@
 '''Template tags used to render pages.'''
+import functools
+import hashlib
+
 import jinja2
 from django import template
 from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Min, Q
+from django.utils import timezone
 from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django_jinja import library
 from jinja2.filters import do_striptags
 
+from cms.apps.pages.localisation import translations
 from cms.apps.pages.models import Page
+from cms.apps.pages.tree import page_tree
 from cms.models import SearchMetaBase
+from cms.models.managers import publication_manager
 from cms.templatetags.html import truncate_paragraphs
 
 register = template.Library()
 
 
 # Navigation.
-def _navigation_entries(context, pages, section=None, is_json=False):
+def navigation_cache_enabled():
+    '''Returns True if built navigation menus should be cached.'''
+    return getattr(settings, 'PAGES_NAVIGATION_CACHE', False)
+
+
+def _navigation_cache_key(request, pages, depth, is_json):
+    '''
+    Returns the cache key for a navigation menu. A menu only changes with the
+    page tree, so the tree version is part of the key.
+    '''
+    country = getattr(request, 'country', None)
+    key = repr((
+        [page.pk for page in pages],
+        depth,
+        is_json,
+        bool(request.user.is_authenticated),
+        getattr(country, 'group_id', None),
+        publication_manager.select_published_active(),
+    ))
+    return 'cms.apps.pages.navigation.{}.{}'.format(
+        page_tree.get_version(),
+        hashlib.md5(key.encode('utf-8')).hexdigest(),
+    )
+
+
+def _mark_here(entries, path):
+    '''Returns a copy of the given entries, marking those on the current path.'''
+    return [
+        dict(
+            entry,
+            here=path.startswith(entry['url']),
+            children=_mark_here(entry['children'], path),
+        )
+        for entry in entries
+    ]
+
+
+def _navigation_entries(context, pages, section=None, is_json=False, depth=None):
+    '''
+    Compiles the navigation entries for the given pages, down to `depth`
+    levels (or the whole tree below them). The pages below them are fetched
+    with a single query.
+    '''
     request = context['request']
-    # Compile the entries.
+    pages = list(pages)
 
-    def page_entry(page):
+    def page_entry(page, level=1):
         # Do nothing if the page is to be hidden from not logged in users
         if page.hide_from_anonymous and not request.user.is_authenticated:
             return
 
-        url = page.get_absolute_url()
+        children = []
+        if (depth is None or level < depth) and page is not request.pages.homepage:
+            children = [
+                entry
+                for entry in (page_entry(child, level + 1) for child in page.navigation)
+                if entry is not None
+            ]
 
-        if is_json:
-            return {
-                'url': url,
-                'title': str(page),
-                'here': request.path.startswith(url),
-                'children': [page_entry(x) for x in page.navigation if
-                             page is not request.pages.homepage]
-            }
         return {
-            'url': url,
+            'url': page.get_absolute_url(),
             'page': page,
             'title': str(page),
-            'here': request.path.startswith(url),
-            'children': [page_entry(x) for x in page.navigation if page is not request.pages.homepage]
+            'children': children,
         }
 
+    def localise_entries(entries):
+        # Swap in the titles of the translations for the current country group.
+        all_entries = []
+        stack = list(entries)
+        while stack:
+            entry = stack.pop()
+            all_entries.append(entry)
+            stack.extend(entry['children'])
+
+        country_group_id = getattr(getattr(request, 'country', None), 'group_id', None)
+        if country_group_id is not None:
+            titles = translations.get_titles(
+                country_group_id,
+                published=publication_manager.select_published_active(),
+            )
+            for entry in all_entries:
+                entry['title'] = titles.get(entry['page'].pk, entry['title'])
+
+        if is_json:
+            for entry in all_entries:
+                del entry['page']
+        return entries
+
+    prefetch_depth = None if depth is None else depth - 1
+
+    def build_entries():
+        Page.objects.prefetch_children(pages, depth=prefetch_depth)
+        return localise_entries([
+            entry
+            for entry in (page_entry(page) for page in pages)
+            if entry is not None
+        ])
+
     # All the applicable nav items
-    entries = [page_entry(x) for x in pages if page_entry(x) is not None]
+    if navigation_cache_enabled():
+        cache_key = _navigation_cache_key(request, pages, depth, is_json)
+        entries = cache.get(cache_key)
+        if entries is None:
+            entries = build_entries()
+            cache.set(cache_key, entries, getattr(settings, 'PAGES_NAVIGATION_CACHE_TIMEOUT', 60))
+    else:
+        entries = build_entries()
+
+    entries = _mark_here(entries, request.path)
 
     # Add the section.
+    section_entry = None
     if section:
+        Page.objects.prefetch_children([section], depth=prefetch_depth)
         section_entry = page_entry(section)
-        section_entry['here'] = context['pages'].current == section_entry['page']
-        entries = [section_entry] + list(entries)
+    if section_entry is not None:
+        section_entry = _mark_here(localise_entries([section_entry]), request.path)[0]
+        section_entry['here'] = context['pages'].current == section
+        entries = [section_entry] + entries
 
     return entries
 
+
+def fragment_cache_enabled():
+    '''Returns True if rendered navigation and breadcrumbs should be cached.'''
+    return getattr(settings, 'PAGES_FRAGMENT_CACHE', False)
+
+
+def _fragment_cache_arg(value):
+    '''
+    Returns a value that identifies the given template function argument in a
+    cache key, or raises TypeError if it can't be identified.
+    '''
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, models.Model):
+        return (value._meta.label, value.pk)
+    if isinstance(value, (list, tuple, models.QuerySet)):
+        return tuple(_fragment_cache_arg(item) for item in value)
+    raise TypeError(f'{value!r} cannot be part of a cache key.')
+
+
+def _next_publication_change(now):
+    '''
+    Returns the next publication or expiry date of any canonical page after
+    the given time, or None if there isn't one.
+    '''
+    dates = Page._base_manager.filter(
+        owner_id__isnull=True,
+        version_for_id__isnull=True,
+    ).aggregate(
+        publication_date=Min('publication_date', filter=Q(publication_date__gt=now)),
+        expiry_date=Min('expiry_date', filter=Q(expiry_date__gt=now)),
+    )
+    dates = [date for date in dates.values() if date is not None]
+    return min(dates) if dates else None
+
+
+def cache_fragment(name):
+    '''
+    Caches the output of a template function in the default cache.
+
+    The output is stored under the path, whether the user is logged in and
+    their country group, along with the page tree version and the next time
+    any page is due to be published or expire. It is used only while both
+    are current, so that a saved page or a scheduled publication date is
+    never served stale. Nothing is cached in preview mode.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(context, *args, **kwargs):
+            request = context.get('request')
+            if (
+                not fragment_cache_enabled()
+                or request is None
+                or getattr(request, 'preview_mode', False)
+                or not publication_manager.select_published_active()
+            ):
+                return func(context, *args, **kwargs)
+
+            # Querysets and lists of pages are evaluated once, here.
+            args = [list(arg) if isinstance(arg, models.QuerySet) else arg for arg in args]
+            try:
+                arguments = _fragment_cache_arg((tuple(args), tuple(sorted(kwargs.items()))))
+            except TypeError:
+                return func(context, *args, **kwargs)
+
+            country = getattr(request, 'country', None)
+            key = repr((
+                arguments,
+                request.path,
+                bool(request.user.is_authenticated),
+                getattr(country, 'group_id', None),
+            ))
+            cache_key = 'cms.apps.pages.fragment.{}.{}'.format(
+                name,
+                hashlib.md5(key.encode('utf-8')).hexdigest(),
+            )
+
+            # Publication is checked to the minute, as in select_published.
+            now = timezone.now().replace(second=0, microsecond=0)
+
+            # The tree version is fetched alongside the fragment, so a cached
+            # render costs a single trip to the cache.
+            values = cache.get_many([page_tree.version_key, cache_key])
+            version = values.get(page_tree.version_key)
+            cached = values.get(cache_key)
+            if (
+                version is not None
+                and cached is not None
+                and cached[0] == version
+                and (cached[1] is None or now < cached[1])
+            ):
+                return mark_safe(cached[2])
+
+            if version is None:
+                version = page_tree.get_version()
+            valid_until = _next_publication_change(now)
+            fragment = func(context, *args, **kwargs)
+            cache.set(
+                cache_key,
+                (version, valid_until, str(fragment)),
+                getattr(settings, 'PAGES_FRAGMENT_CACHE_TIMEOUT', 60),
+            )
+            return fragment
+        return wrapper
+    return decorator
+
+
 def _render_breadcrumbs(context, page=None, extended=False):
     request = context['request']
     # Render the tag.
@@ -74,9 +277,10 @@ def _render_breadcrumbs(context, page=None, extended=False):
     }
 
 @library.global_function
+@cache_fragment('navigation')
 @library.render_with('pages/navigation.html')
 @jinja2.contextfunction
-def render_navigation(context, pages, section=None):
+def render_navigation(context, pages, section=None, depth=None):
     '''
     Renders a navigation list for the given pages.
 
@@ -84,9 +288,12 @@ def render_navigation(context, pages, section=None):
 
     You can also specify an alias for the navigation, at which point it will be set in the
     context rather than rendered.
+
+    The depth of the navigation can be limited by passing `depth`, where
+    `depth=1` renders only the given pages.
     '''
     return {
-        'navigation': _navigation_entries(context, pages, section),
+        'navigation': _navigation_entries(context, pages, section, depth=depth),
     }
 
 
@@ -523,6 +730,7 @@ def render_title(context, browser_title=None):
 
 
 @library.global_function
+@cache_fragment('breadcrumbs')
 @library.render_with('pages/breadcrumbs.html')
 @jinja2.contextfunction
 def render_breadcrumbs(context, page=None, extended=False):
@@ -1,8 +1,10 @@
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseNotFound
 from django.test import RequestFactory, TestCase
 from watson import search
 
+from ..localisation import countries, translations
 from ..middleware import PageMiddleware, RequestPageManager
 from ..models import Country, CountryGroup, Page
 from .models import TestMiddlewarePage, TestMiddlewarePageURLs
@@ -167,6 +169,80 @@ class TestRequestPageManager(TestCase):
         self.assertEqual(self.country_group.__str__(), "United States of America")
         self.assertEqual(self.country.__str__(), "United States of America")
 
+    def test_country_map(self):
+        _generate_pages(self)
+
+        self.assertEqual(countries.get('us'), self.country)
+        with self.assertNumQueries(0):
+            self.assertEqual(countries.get('GB'), self.country_gb)
+            self.assertIsNone(countries.get('fr'))
+            self.assertIsNone(countries.get_or_default('fr'))
+            self.assertEqual(countries.get_or_default('us'), self.country)
+            self.assertEqual(countries.codes, {'us', 'gb'})
+            self.assertEqual(countries.split_path('/gb/foo/'), (self.country_gb, '/foo/'))
+            self.assertEqual(countries.split_path('/gb/'), (self.country_gb, '/'))
+            self.assertEqual(countries.split_path('/fr/foo/'), (None, '/fr/foo/'))
+            self.assertEqual(countries.split_path('/gb'), (None, '/gb'))
+            self.assertEqual(countries.split_path('/GB/'), (None, '/GB/'))
+
+        # Saving a country reloads the map.
+        self.country_gb.default = True
+        self.country_gb.save()
+        self.assertEqual(countries.get_or_default('fr'), self.country_gb)
+        # A matching code takes precedence over the default country.
+        self.assertEqual(countries.get_or_default('us'), self.country)
+
+        # A change made by another process is picked up once it bumps the
+        # shared version.
+        Country.objects.filter(pk=self.country_gb.pk).update(code='UK')
+        self.assertEqual(countries.get('gb'), self.country_gb)
+        cache.set(countries.version_key, 'changed', None)
+        self.assertIsNone(countries.get('gb'))
+        self.assertEqual(countries.get('uk'), self.country_gb)
+
+    def test_inherited_flags(self):
+        _generate_pages(self)
+        self.page_1.hide_from_anonymous = True
+        self.page_1.save()
+
+        self.request = self.factory.get('/foo/bar/')
+        self.page_manager = RequestPageManager(self.request)
+        self.page_manager.current
+
+        with self.assertNumQueries(0):
+            self.assertFalse(self.page_manager.auth_required)
+            self.assertTrue(self.page_manager.hidden_from_anonymous)
+            self.assertTrue(self.page_manager.in_navigation)
+
+        self.request = self.factory.get('/auth/')
+        self.page_manager = RequestPageManager(self.request)
+        self.assertTrue(self.page_manager.auth_required)
+        self.assertFalse(self.page_manager.hidden_from_anonymous)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.page_manager.current.auth_required())
+
+    def test_translation_index(self):
+        _generate_pages(self)
+
+        self.assertEqual(translations.get_titles(self.country_group.pk), {self.homepage.pk: 'Homepage'})
+        with self.assertNumQueries(0):
+            translations.get_titles(self.country_group.pk)
+
+        # Saving a translation drops the index, to be rebuilt when it's next
+        # needed.
+        self.homepage_alt.short_title = 'Home'
+        self.homepage_alt.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(translations.get_titles(self.country_group.pk), {self.homepage.pk: 'Home'})
+
+        self.homepage_alt.is_online = False
+        self.homepage_alt.save()
+        self.assertEqual(translations.get_titles(self.country_group.pk, published=True), {})
+
+        self.homepage_alt.delete()
+        self.assertEqual(translations.get_titles(self.country_group.pk), {})
+
     def test_country(self):
         _generate_pages(self)
 
@@ -179,6 +255,28 @@ class TestRequestPageManager(TestCase):
         self.page_manager = RequestPageManager(self.request)
         self.assertEqual(self.page_manager.country, 'GB')
 
+    def test_alternate_page_version__single_query(self):
+        _generate_pages(self)
+
+        with search.update_index():
+            alternate_page = Page.objects.create(
+                title='Localised bar',
+                slug='bar',
+                owner=self.page_2,
+                country_group=self.country_group,
+                content_type=ContentType.objects.get_for_model(TestMiddlewarePage),
+            )
+
+        self.request = self.factory.get('/foo/bar/')
+        self.request.country = self.country
+        self.page_manager = RequestPageManager(self.request)
+        self.page_manager.breadcrumbs
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.page_manager.section, self.page_1)
+            self.assertEqual(self.page_manager.subsection, alternate_page)
+            self.assertEqual(self.page_manager.current, alternate_page)
+
     def test_alternate_page_version(self):
         _generate_pages(self)
 
@@ -1,6 +1,7 @@
 '''Tests for the pages app.'''
 from datetime import timedelta
 
+from django import urls
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
 from django.db import models
@@ -10,10 +11,14 @@ from reversion import create_revision
 from watson import search
 
 from ....models.managers import publication_manager
-from ...testing_models.models import (TestSection, TestPageContent,
+from ...testing_models.models import (TestInlineModel, TestInlineModelNoPage,
+                                      TestSection, TestPageContent,
+                                      TestPageContentWithFields,
                                       TestPageContentWithSections)
 from ..models import (ContentBase, Page, PageSearchAdapter, PageSitemap,
-                      filter_indexable_pages)
+                      content_registry, filter_indexable_pages,
+                      get_registered_content, resolve_cached)
+from ..utils import duplicate_page, mptt_fix, overlay_obj, publish_pages
 
 
 class TestPage(TestCase):
@@ -100,6 +105,138 @@ class TestPage(TestCase):
         pages = filter_indexable_pages(Page.objects.all())
         self.assertEqual(len(pages), 3)
 
+    def test_content_registry(self):
+        content_type = ContentType.objects.get_for_model(TestPageContent)
+        entry = content_registry.get(content_type.pk)
+
+        self.assertIs(entry.model, TestPageContent)
+        self.assertEqual(entry.urlconf, TestPageContent.urlconf)
+        self.assertEqual(entry.template_names[0], 'testing_models/testpagecontent.html')
+        self.assertIn(TestPageContent, get_registered_content())
+
+        with self.assertNumQueries(0):
+            self.assertIs(content_registry.get(content_type.pk), entry)
+            self.assertEqual(self.homepage.reverse('detail', kwargs={'slug': 'foo'}), '/foo/')
+
+        # A content type whose model has been removed has no urlconf, rather
+        # than falling back to the root one.
+        stale_content_type = ContentType.objects.create(app_label='testing_models', model='removedcontent')
+        entry = content_registry.get(stale_content_type.pk)
+        self.assertIsNone(entry.model)
+        self.assertIsNone(entry.urlconf)
+        self.homepage.content_type = stale_content_type
+        with self.assertRaises(urls.NoReverseMatch):
+            self.homepage.reverse('detail', kwargs={'slug': 'foo'})
+
+    def test_resolve_cached(self):
+        match = resolve_cached('/foo/', TestPageContent.urlconf)
+        self.assertEqual(match.url_name, 'detail')
+        self.assertEqual(match.kwargs, {'slug': 'foo'})
+        self.assertIs(resolve_cached('/foo/', TestPageContent.urlconf), match)
+        self.assertIsNone(resolve_cached('/foo/bar/baz/', TestPageContent.urlconf))
+
+    def test_overlay_obj(self):
+        TestSection.objects.create(page=self.section, title='Overlaid')
+        TestSection.objects.create(page=self.homepage, title='Original')
+
+        with self.assertNumQueries(1):
+            page = overlay_obj(
+                self.homepage,
+                self.section,
+                exclude=['pk', 'id', 'version_for', 'left', 'right'],
+                related_fields=['testsection'],
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual([section.title for section in page.testsection_set.all()], ['Overlaid'])
+            page.save()
+
+        # Other pages are unaffected, and the overlay class is reused.
+        self.assertEqual([section.title for section in Page.objects.get(pk=self.homepage.pk).testsection_set.all()], ['Original'])
+        other_page = overlay_obj(Page.objects.get(pk=self.subsection.pk), self.section, related_fields=[])
+        self.assertIs(other_page.__class__, page.__class__)
+        self.assertEqual([section.title for section in other_page.testsection_set.all()], [])
+
+    def test_duplicate_page(self):
+        with search.update_index():
+            page = Page.objects.create(
+                parent=self.homepage,
+                title='Fields',
+                content_type=ContentType.objects.get_for_model(TestPageContentWithFields),
+            )
+            content = TestPageContentWithFields.objects.create(
+                page=page,
+                description='Description',
+            )
+            content.inline_model.set(TestInlineModelNoPage.objects.create() for _ in range(3))
+            for _ in range(5):
+                TestInlineModel.objects.create(page=page)
+
+        def version_changes(new_page, original_page):
+            new_page.version_for = original_page
+            new_page.left = None
+            new_page.right = None
+            return new_page
+
+        version = duplicate_page(Page.objects.get(pk=page.pk), version_changes)
+
+        self.assertNotEqual(version.pk, page.pk)
+        self.assertEqual(version.version_for, page)
+        self.assertEqual(version.content.description, 'Description')
+        self.assertEqual(version.content.inline_model.count(), 3)
+        self.assertEqual(TestInlineModel.objects.filter(page=version).count(), 5)
+        self.assertEqual(TestInlineModel.objects.filter(page=page).count(), 5)
+
+    def test_publish_pages(self):
+        with search.update_index():
+            draft = Page.objects.create(
+                parent=self.homepage,
+                title='Draft section',
+                slug=self.section.slug,
+                version_for=self.section,
+                content_type=self.section.content_type,
+            )
+            TestPageContent.objects.create(page=draft)
+
+        results = publish_pages(Page.objects.filter(pk=draft.pk))
+
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[0].live_page.pk, self.section.pk)
+        self.assertEqual(Page.objects.get(pk=self.section.pk).title, 'Draft section')
+        self.assertFalse(Page.objects.filter(pk=draft.pk).exists())
+
+        # The page that was live is kept as a version, with its content.
+        archived_page = Page.objects.get(version_for=self.section)
+        self.assertEqual(archived_page.title, 'Section')
+        self.assertEqual(archived_page.url_path, self.section.url_path)
+        self.assertIsInstance(archived_page.content, TestPageContent)
+
+    def test_publish_pages__several_drafts(self):
+        drafts = []
+        with search.update_index():
+            for number in range(2):
+                draft = Page.objects.create(
+                    parent=self.homepage,
+                    title=f'Draft {number}',
+                    slug=self.section.slug,
+                    version_for=self.section,
+                    version_publication_date=now() - timedelta(days=2 - number),
+                    content_type=self.section.content_type,
+                )
+                TestPageContent.objects.create(page=draft)
+                drafts.append(draft)
+
+        # The drafts are published oldest first, whatever order they're given
+        # in, and each state of the live page is archived.
+        results = publish_pages(Page.objects.filter(pk__in=[draft.pk for draft in drafts]).order_by('-pk'))
+
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertEqual(Page.objects.get(pk=self.section.pk).title, 'Draft 1')
+        self.assertEqual(
+            sorted(Page.objects.filter(version_for=self.section).values_list('title', flat=True)),
+            ['Draft 0', 'Section'],
+        )
+
     def test_pagesitemap_items(self):
         sitemap = PageSitemap()
         self.assertEqual(len(sitemap.items()), 4)
@@ -151,6 +288,82 @@ class TestPage(TestCase):
         new_page = Page.objects.get(pk=new_page.pk)
         self.assertEqual(new_page.get_absolute_url(), '/')
 
+    def test_get_path_pages(self):
+        # Saving the pages rebuilds their url_path.
+        self.section.slug = 'section'
+        self.section.save()
+        self.subsection.refresh_from_db()
+        self.subsection.slug = 'subsection'
+        self.subsection.save()
+
+        with self.assertNumQueries(1):
+            pages = Page.objects.get_path_pages(['section', 'subsection', 'missing'])
+            self.assertEqual(pages, [self.homepage, self.section, self.subsection])
+            self.assertEqual(pages[-1].get_absolute_url(), '/section/subsection/')
+
+        self.assertEqual(Page.objects.get_path_pages(['missing']), [self.homepage])
+
+        Page.objects.filter(pk=self.section.pk).update(is_online=False)
+
+        with publication_manager.select_published(True):
+            self.assertEqual(Page.objects.get_path_pages(['section', 'subsection']), [self.homepage])
+
+    def test_page_url_path(self):
+        self.subsubsection.slug = 'subsubsection'
+        self.subsubsection.save()
+        self.subsection.slug = 'subsection'
+        self.subsection.save()
+        self.section.slug = 'section'
+        self.section.save()
+
+        self.subsection.refresh_from_db()
+        self.subsubsection.refresh_from_db()
+        self.assertEqual(self.section.url_path, '/section/')
+        self.assertEqual(self.subsection.url_path, '/section/subsection/')
+        self.assertEqual(self.subsubsection.get_absolute_url(), '/section/subsection/subsubsection/')
+
+        # Moving a page rewrites the URLs of its whole branch.
+        self.subsection.parent = self.homepage
+        self.subsection.save()
+
+        self.subsubsection.refresh_from_db()
+        self.assertEqual(self.subsection.get_absolute_url(), '/subsection/')
+        self.assertEqual(self.subsubsection.url_path, '/subsection/subsubsection/')
+
+    def test_effective_publication(self):
+        self.section.is_online = False
+        self.section.publication_date = now() - timedelta(days=1)
+        self.section.save()
+
+        self.subsubsection.refresh_from_db()
+        self.assertFalse(self.subsubsection.effective_online)
+        self.assertEqual(self.subsubsection.effective_publication_date, self.section.publication_date)
+
+        with publication_manager.select_published(True):
+            pages = list(Page.objects.all())
+
+            with self.settings(PAGES_EFFECTIVE_PUBLICATION=True):
+                self.assertEqual(list(Page.objects.all()), pages)
+                self.assertEqual(pages, [self.homepage])
+
+        self.section.is_online = True
+        self.section.save()
+
+        self.subsubsection.refresh_from_db()
+        self.assertTrue(self.subsubsection.effective_online)
+
+    def test_with_content(self):
+        with self.assertNumQueries(2):
+            pages = list(Page.objects.with_content())
+            self.assertEqual(len(pages), 4)
+            for page in pages:
+                self.assertEqual(page.content.page, page)
+
+        # Filtering keeps the prefetch.
+        with self.assertNumQueries(2):
+            page = Page.objects.with_content().filter(pk=self.section.pk).get()
+            self.assertEqual(page.content.pk, self.section.pk)
+
     def test_last_modified(self):
 
         # We have no versions
@@ -472,6 +685,12 @@ class TestPageComplex(TestCase):
         self.assertEqual(self.pages['Tree_3___Page_5'].left, 8)
         self.assertEqual(self.pages['Tree_3___Page_5'].right, 9)
 
+    def test_page_save__move_into_own_branch(self):
+        self.pages['Tree_3___Page_1'].parent = self.pages['Tree_3___Page_2']
+
+        with self.assertRaises(ValueError):
+            self.pages['Tree_3___Page_1'].save()
+
     def test_page_delete(self):
         self.pages['Tree_3___Page_5'].content.delete()
         self.pages['Tree_3___Page_5'].delete()
@@ -500,3 +719,79 @@ class TestPageComplex(TestCase):
 
         with self.assertRaises(KeyError):
             self.pages['Tree_3___Page_5']
+
+
+class TestSparsePageTree(TestCase):
+
+    def _create_page(self, slug, parent=None):
+        with search.update_index():
+            return Page.objects.create(
+                title=slug,
+                slug=slug,
+                parent=parent,
+                content_type=ContentType.objects.get_for_model(TestPageContent),
+            )
+
+    def test_sparse_insert(self):
+        with self.settings(PAGES_TREE_GAP=8):
+            homepage = self._create_page('homepage')
+            first = self._create_page('first', parent=homepage)
+            # The tree has been renumbered to make room.
+            homepage.refresh_from_db()
+            self.assertEqual((homepage.left, homepage.right), (1, 10))
+
+            tree_values = list(Page.objects.values_list('pk', 'left', 'right'))
+            second = self._create_page('second', parent=homepage)
+
+            # Nothing else has moved.
+            self.assertEqual(list(Page.objects.exclude(pk=second.pk).values_list('pk', 'left', 'right')), tree_values)
+            self.assertGreater(second.left, first.right)
+            self.assertLess(second.right, homepage.right)
+
+            for slug in ['third', 'fourth', 'fifth']:
+                self._create_page(slug, parent=homepage)
+
+            self.assertEqual(
+                list(Page.objects.filter(parent=homepage).values_list('slug', flat=True)),
+                ['first', 'second', 'third', 'fourth', 'fifth'],
+            )
+
+            child = self._create_page('child', parent=second)
+            homepage.refresh_from_db()
+            second.refresh_from_db()
+            self.assertEqual(
+                list(Page.objects.filter(left__lt=child.left, right__gt=child.right).values_list('pk', flat=True)),
+                [homepage.pk, second.pk],
+            )
+            # The child fits in the gap without widening its parent.
+            self.assertLessEqual(second.right - second.left, 1 + 8)
+            self.assertEqual(second.children, [child])
+
+            # Moving a branch keeps it in order under its new parent.
+            second.parent = first
+            second.save()
+            first.refresh_from_db()
+            child.refresh_from_db()
+            self.assertTrue(first.left < second.left < child.left < child.right < second.right < first.right)
+
+    def test_mptt_fix(self):
+        homepage = self._create_page('homepage')
+        first = self._create_page('first', parent=homepage)
+        second = self._create_page('second', parent=homepage)
+        expected = list(Page.objects.order_by('left').values_list('pk', 'left', 'right'))
+
+        Page.objects.filter(pk=second.pk).update(left=20, right=21)
+        Page.objects.filter(pk=homepage.pk).update(right=22)
+
+        changed_nodes, orphans = mptt_fix(gap=0, dry_run=True)
+        self.assertEqual(sorted(node.obj.pk for node in changed_nodes), sorted([homepage.pk, second.pk]))
+        self.assertEqual(orphans, [])
+        self.assertEqual(Page.objects.get(pk=second.pk).left, 20)
+
+        changed_nodes, _ = mptt_fix(gap=0)
+        self.assertEqual(
+            sorted((node.old_left, node.leftattr) for node in changed_nodes),
+            sorted([(expected[0][1], expected[0][1]), (20, expected[2][1])]),
+        )
+        self.assertEqual(list(Page.objects.order_by('left').values_list('pk', 'left', 'right')), expected)
+        self.assertEqual(expected[1][0], first.pk)
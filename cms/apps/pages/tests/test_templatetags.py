@@ -1,15 +1,20 @@
 import base64
 import random
+from datetime import timedelta
+from unittest import mock
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import Client, RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import six
 from django.utils.timezone import now
 from watson import search
 
 from cms.apps.media.models import File
 
+from ....models.managers import publication_manager
 from ..middleware import RequestPageManager
 from ..models import ContentBase, Country, Page
 from ..templatetags.pages import (_navigation_entries, absolute_domain_url,
@@ -207,6 +212,26 @@ class TestTemplatetags(TestCase):
 
         self.assertListEqual(navigation, [])
 
+    def test_navigation_entries__single_query(self):
+        request = self.factory.get('/section/')
+        request.user = MockUser(authenticated=True)
+        request.pages = RequestPageManager(request)
+        pages = list(request.pages.homepage.navigation)
+
+        with self.assertNumQueries(1):
+            navigation = _navigation_entries({'request': request}, pages)
+
+        self.assertEqual(
+            navigation[0]['children'][0]['children'][0]['page'],
+            self.subsubsection,
+        )
+        self.assertTrue(navigation[0]['here'])
+        self.assertFalse(navigation[0]['children'][0]['here'])
+
+        # Limiting the depth stops at the given pages.
+        navigation = _navigation_entries({'request': request}, request.pages.homepage.navigation, depth=1)
+        self.assertEqual(navigation[0]['children'], [])
+
     def test_render_navigation(self):
         request = self.factory.get('/')
         request.user = MockUser(authenticated=True)
@@ -218,6 +243,35 @@ class TestTemplatetags(TestCase):
 
         self.assertTrue(len(navigation) > 0)
 
+    def test_render_navigation__fragment_cache(self):
+        request = self.factory.get('/')
+        request.user = MockUser(authenticated=True)
+        request.pages = RequestPageManager(request)
+
+        with self.settings(PAGES_FRAGMENT_CACHE=True), publication_manager.select_published(True):
+            pages = request.pages.current.navigation
+            navigation = render_navigation({'request': request}, pages)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(render_navigation({'request': request}, pages), navigation)
+
+            # Saving a page changes the tree version.
+            self.section.title = 'Renamed'
+            self.section.save()
+            self.assertIn('Renamed', render_navigation({'request': request}, [self.section]))
+
+            # A fragment is rendered again once a scheduled publication date
+            # has passed.
+            publication_date = now() + timedelta(days=1)
+            Page.objects.filter(pk=self.subsubsection.pk).update(publication_date=publication_date)
+            navigation = render_navigation({'request': request}, [self.section])
+            with self.assertNumQueries(0):
+                self.assertEqual(render_navigation({'request': request}, [self.section]), navigation)
+            with mock.patch('cms.apps.pages.templatetags.pages.timezone.now', return_value=publication_date + timedelta(minutes=1)):
+                with CaptureQueriesContext(connection) as queries:
+                    render_navigation({'request': request}, [self.section])
+            self.assertTrue(queries.captured_queries)
+
     def test_page_url(self):
         self.assertEqual(get_page_url(self.homepage), '/')
         self.assertEqual(get_page_url(self.homepage.pk), '/')
@@ -0,0 +1,131 @@
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import RequestFactory, TestCase
+from django.utils.timezone import now
+from watson import search
+
+from ..middleware import RequestPageManager
+from ..models import Page
+from ..tree import PageTreeSnapshot, page_tree
+from .models import TestMiddlewarePage
+
+
+class TestPageTree(TestCase):
+
+    def setUp(self):
+        with search.update_index():
+            content_type = ContentType.objects.get_for_model(TestMiddlewarePage)
+
+            self.homepage = Page.objects.create(
+                title='Homepage',
+                slug='homepage',
+                content_type=content_type,
+            )
+
+            self.section = Page.objects.create(
+                title='Section',
+                slug='section',
+                parent=self.homepage,
+                content_type=content_type,
+            )
+
+            self.subsection = Page.objects.create(
+                title='Subsection',
+                slug='subsection',
+                parent=self.section,
+                content_type=content_type,
+            )
+
+            self.future = Page.objects.create(
+                title='Future',
+                slug='future',
+                parent=self.homepage,
+                publication_date=now() + timedelta(days=1),
+                content_type=content_type,
+            )
+
+    def test_resolve_path(self):
+        tree = PageTreeSnapshot.load()
+
+        self.assertEqual(tree.homepage_id, self.homepage.pk)
+        self.assertEqual(
+            [entry.id for entry in tree.resolve_path(['section', 'subsection'])],
+            [self.homepage.pk, self.section.pk, self.subsection.pk],
+        )
+        self.assertEqual(
+            [entry.id for entry in tree.resolve_path(['section', 'missing'])],
+            [self.homepage.pk, self.section.pk],
+        )
+        self.assertEqual(
+            [entry.id for entry in tree.get_ancestors(self.subsection.pk)],
+            [self.homepage.pk, self.section.pk],
+        )
+
+    def test_published(self):
+        tree = PageTreeSnapshot.load()
+
+        self.assertEqual(len(tree.resolve_path(['future'])), 2)
+        self.assertEqual(len(tree.resolve_path(['future'], published=True)), 1)
+        self.assertEqual(
+            [entry.id for entry in tree.get_children(self.homepage.pk, published=True)],
+            [self.section.pk],
+        )
+
+        self.section.is_online = False
+        self.section.save()
+
+        tree = PageTreeSnapshot.load()
+        self.assertFalse(tree.is_published(self.subsection.pk))
+        self.assertEqual(tree.get_children(self.section.pk, published=True), [])
+
+    def test_get_page(self):
+        tree = PageTreeSnapshot.load()
+        homepage = tree.get_page(tree.homepage)
+        page = tree.get_page(tree.get(self.subsection.pk))
+        expected = Page.objects.get(pk=self.subsection.pk)
+
+        for field_name in tree.get(self.subsection.pk)._fields:
+            self.assertEqual(getattr(page, field_name), getattr(expected, field_name), field_name)
+
+        # Finding the children of a snapshot page doesn't load anything.
+        with self.settings(PAGES_TREE_CACHE=True):
+            page_tree.get()
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    [child.pk for child in homepage.children],
+                    [self.section.pk, self.future.pk],
+                )
+
+    def test_invalidation(self):
+        tree = page_tree.get()
+        self.assertIs(page_tree.get(), tree)
+
+        self.section.title = 'Renamed'
+        self.section.save()
+
+        tree = page_tree.get()
+        self.assertEqual(tree.get(self.section.pk).title, 'Renamed')
+
+    def test_request_page_manager(self):
+        with self.settings(PAGES_TREE_CACHE=True):
+            page_tree.get()
+
+            request = RequestFactory().get('/section/subsection/')
+            page_manager = RequestPageManager(request)
+
+            with self.assertNumQueries(1):
+                self.assertListEqual(page_manager.breadcrumbs, [
+                    self.homepage,
+                    self.section,
+                    self.subsection,
+                ])
+                self.assertEqual(page_manager.homepage, self.homepage)
+                self.assertEqual(page_manager.current, self.subsection)
+                self.assertEqual(page_manager.current.get_absolute_url(), '/section/subsection/')
+
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    [child.title for child in page_manager.homepage.children],
+                    ['Section', 'Future'],
+                )
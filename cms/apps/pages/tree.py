@@ -0,0 +1,258 @@
+'''
+An in-process snapshot of the canonical page tree.
+
+Loading the page tree one level at a time costs a query per level of the
+requested URL, plus one for every page whose children are rendered in the
+navigation. The snapshot holds the handful of columns needed to resolve
+URLs and build navigation for every canonical page, so that walking the
+tree costs no queries at all.
+
+A snapshot is loaded at most once per process for each version of the tree.
+The version is kept in the default cache so that every process sharing that
+cache notices when a page is saved, deleted or moved.
+'''
+import threading
+import uuid
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+TREE_FIELDS = (
+    'id',
+    'parent_id',
+    'left',
+    'right',
+    'slug',
+    'url_path',
+    'title',
+    'short_title',
+    'in_navigation',
+    'hide_from_anonymous',
+    'requires_authentication',
+    'is_online',
+    'publication_date',
+    'expiry_date',
+    'content_type_id',
+    'owner_id',
+    'version_for_id',
+)
+
+PageTreeEntry = namedtuple('PageTreeEntry', TREE_FIELDS)
+
+
+def tree_cache_enabled():
+    '''Returns True if the page tree snapshot should be used.'''
+    return getattr(settings, 'PAGES_TREE_CACHE', False)
+
+
+class PageTreeSnapshot:
+
+    '''An immutable copy of the canonical page tree.'''
+
+    def __init__(self, entries, version=None):
+        self.version = version
+        self._entries = {}
+        children = {}
+
+        for entry in sorted(entries, key=lambda entry: entry.left):
+            self._entries[entry.id] = entry
+            children.setdefault(entry.parent_id, []).append(entry.id)
+
+        self._children = dict(
+            (parent_id, tuple(child_ids))
+            for parent_id, child_ids
+            in children.items()
+        )
+
+        roots = self._children.get(None, ())
+        self.homepage_id = roots[0] if roots else None
+
+    def __contains__(self, page_id):
+        return page_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, page_id):
+        '''Returns the entry for the given page ID, or None.'''
+        return self._entries.get(page_id)
+
+    @property
+    def homepage(self):
+        '''The entry for the site homepage, or None.'''
+        return self.get(self.homepage_id)
+
+    def get_children(self, page_id, published=False):
+        '''Returns the child entries of the given page, in tree order.'''
+        entries = [self._entries[child_id] for child_id in self._children.get(page_id, ())]
+        if published:
+            now = _publication_now()
+            if not self.is_published(page_id, now):
+                return []
+            entries = [entry for entry in entries if _entry_is_published(entry, now)]
+        return entries
+
+    def get_ancestors(self, page_id):
+        '''Returns the ancestor entries of the given page, homepage first.'''
+        ancestors = []
+        entry = self.get(page_id)
+        while entry is not None and entry.parent_id is not None:
+            entry = self.get(entry.parent_id)
+            if entry is not None:
+                ancestors.append(entry)
+        ancestors.reverse()
+        return ancestors
+
+    def is_published(self, page_id, now=None):
+        '''
+        Returns True if the given page and all of its ancestors are published,
+        mirroring PageManager.select_published.
+        '''
+        if now is None:
+            now = _publication_now()
+        entry = self.get(page_id)
+        if entry is None:
+            return False
+        while entry is not None:
+            if not _entry_is_published(entry, now):
+                return False
+            entry = self.get(entry.parent_id)
+        return True
+
+    def resolve_path(self, slugs, published=False):
+        '''
+        Returns the chain of entries matching the given list of slugs, starting
+        at the homepage and stopping at the deepest matching page.
+        '''
+        homepage = self.homepage
+        if homepage is None:
+            return []
+
+        now = _publication_now()
+        if published and not self.is_published(homepage.id, now):
+            return []
+
+        chain = [homepage]
+        for slug in slugs:
+            for child_id in self._children.get(chain[-1].id, ()):
+                child = self._entries[child_id]
+                # Ancestors have already been checked on the way down.
+                if child.slug == slug and (not published or _entry_is_published(child, now)):
+                    chain.append(child)
+                    break
+            else:
+                break
+        return chain
+
+    def get_page(self, entry, parent=None):
+        '''
+        Returns a Page instance built from the given entry. Fields that are
+        not held in the snapshot are deferred.
+        '''
+        page_model = apps.get_model('pages', 'Page')
+        # from_db expects the values in the order of the model's fields.
+        field_names = [
+            field.attname
+            for field in page_model._meta.concrete_fields
+            if field.attname in TREE_FIELDS
+        ]
+        page = page_model.from_db(
+            page_model.objects.db,
+            field_names,
+            [getattr(entry, field_name) for field_name in field_names],
+        )
+        page.is_canonical_page = True
+        if parent is not None:
+            page.parent = parent
+        return page
+
+    @classmethod
+    def load(cls, version=None):
+        '''Loads a snapshot of the canonical page tree with a single query.'''
+        page_model = apps.get_model('pages', 'Page')
+        rows = page_model._base_manager.filter(
+            owner_id__isnull=True,
+            version_for_id__isnull=True,
+        ).values_list(*TREE_FIELDS)
+        return cls([PageTreeEntry(*row) for row in rows], version=version)
+
+
+def _publication_now():
+    return timezone.now().replace(second=0, microsecond=0)
+
+
+def _entry_is_published(entry, now):
+    return (
+        entry.is_online
+        and (entry.publication_date is None or entry.publication_date <= now)
+        and (entry.expiry_date is None or entry.expiry_date > now)
+    )
+
+
+class PageTreeCache:
+
+    '''
+    Holds the page tree snapshot for this process, reloading it whenever the
+    shared tree version changes.
+    '''
+
+    version_key = 'cms.apps.pages.tree.version'
+
+    def __init__(self):
+        '''Initializes the PageTreeCache.'''
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def get_version(self):
+        '''Returns the current version token of the page tree.'''
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    def get(self):
+        '''
+        Returns an up to date snapshot of the page tree. This costs a single
+        cache lookup unless the tree has changed since it was last loaded.
+        '''
+        version = self.get_version()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = PageTreeSnapshot.load(version=version)
+                    self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        '''Marks the page tree as changed in every process.'''
+        self._snapshot = None
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+
+
+# A single, thread-safe page tree cache.
+page_tree = PageTreeCache()
+
+
+def invalidate_page_tree():
+    '''
+    Invalidates the page tree now and again when the current transaction
+    commits, so that a snapshot loaded by another process before the commit
+    is not kept.
+    '''
+    page_tree.invalidate()
+    transaction.on_commit(page_tree.invalidate)
+
+
+@receiver(post_save, sender='pages.Page')
+@receiver(post_delete, sender='pages.Page')
+def page_tree_changed(sender, **kwargs):
+    invalidate_page_tree()
@@ -1,12 +1,78 @@
+import functools
+import time
+from collections import namedtuple
 from copy import deepcopy
 
 from django.contrib import admin
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, prefetch_related_objects
 from django.forms.models import _get_foreign_key
 from watson.search import update_index
 
-from .models import Page, publication_manager
+from .models import (Page, get_page_tree_gap, lock_page_tree,
+                     prefetch_page_content, publication_manager)
+from .tree import invalidate_page_tree
+
+
+class OverlayRelatedDescriptor:
+    '''
+    Returns the overlaid objects for a relation if an instance has any, or
+    the model's own related manager otherwise.
+    '''
+
+    def __init__(self, accessor, descriptor):
+        self.accessor = accessor
+        self.descriptor = descriptor
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        overlay_related = instance.__dict__.get('_overlay_related', {})
+        if self.accessor in overlay_related:
+            return overlay_related[self.accessor]
+        return self.descriptor.__get__(instance, owner)
+
+
+def get_related_accessor(field):
+    '''Returns the name of the attribute that holds the related objects of the given field.'''
+    if isinstance(field, models.ManyToManyField):
+        return field.name
+    return field.get_accessor_name()
+
+
+_overlay_classes = {}
+
+
+def get_overlay_class(model):
+    '''
+    Returns a subclass of the given model that can't be saved or deleted, and
+    whose related objects can be replaced for each instance. The class is only
+    created once for each model.
+    '''
+    overlay_cls = _overlay_classes.get(model)
+    if overlay_cls is not None:
+        return overlay_cls
+
+    class DummyObject(model):
+        class Meta:
+            abstract = True
+
+        def save(self, **kwargs):
+            pass
+
+        def delete(self, **kwargs):
+            pass
+
+    for field in model._meta.get_fields():
+        if isinstance(field, (models.ManyToManyField, models.ManyToManyRel, models.ManyToOneRel)):
+            accessor = get_related_accessor(field)
+            if accessor:
+                setattr(DummyObject, accessor, OverlayRelatedDescriptor(accessor, getattr(model, accessor)))
+
+    DummyObject._meta = model._meta
+
+    _overlay_classes[model] = DummyObject
+    return DummyObject
 
 
 def overlay_obj(original, overlay, exclude=None, related_fields=None, commit=False):
@@ -30,34 +96,28 @@ def overlay_obj(original, overlay, exclude=None, related_fields=None, commit=Fal
     if commit:
         original.save()
         for field in deffered_fields:
-            if isinstance(field, models.ManyToManyField):
-                accessor = field.name
-            else:
-                accessor = field.get_accessor_name()
+            accessor = get_related_accessor(field)
             old_qs = getattr(overlay, accessor).all()
             # Delete stale inlines
             if isinstance(field, models.ManyToOneRel):
                 getattr(original, accessor).all().delete()
             getattr(original, accessor).set(old_qs, clear=True)
     else:
-        class DummyObject(original.__class__):
-            class Meta:
-                abstract = True
-
-            def save(self, **kwargs):
-                pass
+        accessors = [
+            get_related_accessor(field)
+            for field in deffered_fields
+            if not isinstance(field, models.OneToOneRel)
+        ]
+        accessors = [accessor for accessor in accessors if accessor]
 
-            def delete(self, **kwargs):
-                pass
+        # Load all the related objects of the overlay in one pass.
+        prefetch_related_objects([overlay], *accessors)
 
-        for field in deffered_fields:
-            accessor = field.get_accessor_name()
-            old_qs = getattr(overlay, accessor).all()
-            setattr(DummyObject, accessor, old_qs)
+        overlay_related = original.__dict__.setdefault('_overlay_related', {})
+        for accessor in accessors:
+            overlay_related[accessor] = getattr(overlay, accessor).all()
 
-        DummyObject._meta = original.__class__._meta
-
-        original.__class__ = DummyObject
+        original.__class__ = get_overlay_class(original._meta.model)
 
     return original
 
@@ -78,45 +138,150 @@ def duplicate_object(original_object, changes=None):
         copied_object.save()
 
 
+def copy_instance(obj, **changes):
+    '''
+    Returns an unsaved copy of the given model instance with a new primary key,
+    with the given field values changed.
+    '''
+    values = dict(
+        (field.attname, getattr(obj, field.attname))
+        for field in obj._meta.concrete_fields
+        if not isinstance(field, models.AutoField)
+    )
+    values.update(changes)
+    return obj._meta.model(**values)
+
+
+def copy_many_to_many(model, copied_ids):
+    '''
+    Copies the many to many links of the given model's objects to their
+    copies, with a single bulk insert for each relation. `copied_ids` maps
+    the ID of each original object to the ID of its copy.
+    '''
+    if not copied_ids:
+        return
+
+    for field in model._meta.many_to_many:
+        through = field.remote_field.through
+        source_field = through._meta.get_field(field.m2m_field_name())
+        through._default_manager.bulk_create([
+            copy_instance(link, **{source_field.attname: copied_ids[getattr(link, source_field.attname)]})
+            for link in through._default_manager.filter(**{f'{source_field.attname}__in': list(copied_ids)})
+        ])
+
+
+def duplicate_pages(original_pages, page_changes=None):
+    '''
+    Duplicates the given pages along with their content and content inlines,
+    and returns the copies in the same order.
+
+    Copies that aren't in the page tree, such as archived versions, are
+    created with a single bulk insert for each type of object. Pages in the
+    tree are saved one at a time so that they can be given their place in it.
+    Like `duplicate_page`, this takes an optional function to change each
+    copy before it is saved.
+    '''
+    original_pages = list(original_pages)
+
+    pages = []
+    bulk_pages = []
+    for original_page in original_pages:
+        page = copy_instance(original_page)
+        if callable(page_changes):
+            page = page_changes(page, original_page)
+        if page.owner_id is None and page.version_for_id is None:
+            page.save()
+        else:
+            # Translations and versions are not in the tree, so inherit nothing.
+            page.effective_online = page.is_online
+            page.effective_publication_date = page.publication_date
+            page.effective_expiry_date = page.expiry_date
+            bulk_pages.append(page)
+        pages.append(page)
+    Page.objects.bulk_create(bulk_pages)
+
+    duplicate_page_content(original_pages, pages)
+
+    return pages
+
+
+def duplicate_page_content(original_pages, pages):
+    '''
+    Copies the content, content inlines and many to many links of the given
+    pages to their copies. Each type of object is created with a single bulk
+    insert, so this takes the same number of queries however many inlines
+    the pages have.
+    '''
+    from .admin import page_admin
+
+    prefetch_page_content(original_pages)
+
+    copied_page_ids = dict(
+        (original_page.pk, page.pk)
+        for original_page, page in zip(original_pages, pages)
+    )
+    copy_many_to_many(Page, copied_page_ids)
+
+    # Copy the content, a content model at a time.
+    contents_by_model = {}
+    for original_page, page in zip(original_pages, pages):
+        content = original_page.content
+        contents_by_model.setdefault(content._meta.model, []).append(content)
+    for content_model, contents in contents_by_model.items():
+        content_model._default_manager.bulk_create([
+            copy_instance(content, page_id=copied_page_ids[content.page_id])
+            for content in contents
+        ])
+        copy_many_to_many(content_model, dict(
+            (content.page_id, copied_page_ids[content.page_id])
+            for content in contents
+        ))
+
+    # Copy the content inlines, an inline model at a time.
+    for content_cls, admin_cls in page_admin.content_inlines:
+        page_ids = [
+            original_page.pk
+            for original_page in original_pages
+            if isinstance(original_page.content, content_cls)
+        ]
+        if not page_ids:
+            continue
+
+        model_cls = admin_cls.model
+        fk = _get_foreign_key(Page, model_cls, fk_name=admin_cls.fk_name)
+        related_items = list(model_cls._default_manager.filter(**{f'{fk.name}__in': page_ids}).distinct())
+        new_items = model_cls._default_manager.bulk_create([
+            copy_instance(item, **{fk.attname: copied_page_ids[getattr(item, fk.attname)]})
+            for item in related_items
+        ])
+        copy_many_to_many(model_cls, dict(
+            (item.pk, new_item.pk)
+            for item, new_item in zip(related_items, new_items)
+        ))
+
+
 def duplicate_page(original_page, page_changes=None):
     '''
         Takes a page and duplicates it as a child of the original's parent page.
         Expects to be passed the original page and an optional function
     '''
-    from .admin import page_admin
-    original_content = original_page.content
-
     with update_index():
-        page = deepcopy(original_page)
-        page.pk = None
+        page = copy_instance(original_page)
 
         if callable(page_changes):
             page = page_changes(page, original_page)
 
         page.save()
 
-        content = deepcopy(original_content)
-        content.pk = None
-        content.page = page
-        content.save()
+        duplicate_page_content([original_page], [page])
 
-        # This doesn't copy m2m relations on the copied inline
-        for content_cls, admin_cls in page_admin.content_inlines:
-            if not isinstance(content, content_cls):
-                continue
-
-            model_cls = admin_cls.model
-            fk = _get_foreign_key(Page, model_cls, fk_name=admin_cls.fk_name)
+    return page
 
-            related_items = model_cls.objects.filter(**{fk.name: original_page.pk}).distinct().all()
-            for item in related_items:
-                new_object = deepcopy(item)
-                new_object.pk = None
-                setattr(new_object, fk.name, page)
-                new_object = overlay_obj(new_object, item, exclude=[fk.name, 'pk', 'id'], commit=True)
-                new_object.save()
 
-    return page
+@functools.lru_cache(maxsize=None)
+def get_inline_related_name(model, fk_name=None):
+    '''Returns the name that pages use to look up the given inline model.'''
+    return _get_foreign_key(Page, model, fk_name=fk_name).related_query_name()
 
 
 def overlay_page_obj(original_page, overlay_page, commit=False):
@@ -131,18 +296,13 @@ def overlay_page_obj(original_page, overlay_page, commit=False):
     checked_models = []
     related_fields = []
 
-    def do_model_inline(cls):
-        checked_models.append(cls.model)
-        fk = _get_foreign_key(Page, cls.model, fk_name=cls.fk_name)
-
-        return fk.related_query_name()
-
     for _, admin_cls in page_admin.content_inlines:
 
         if admin_cls.model in checked_models:
             continue
 
-        related_fields.append(do_model_inline(admin_cls))
+        checked_models.append(admin_cls.model)
+        related_fields.append(get_inline_related_name(admin_cls.model, admin_cls.fk_name))
 
     # Overlay page fields
     overlay_obj(original_page, overlay_page, page_fields_exclude, related_fields, commit=commit)
@@ -153,60 +313,195 @@ def overlay_page_obj(original_page, overlay_page, commit=False):
     return original_page
 
 
-def publish_page(page):
-    def page_changes(new_page, original_page):
-        new_page.version_for = original_page
-        new_page.left = None
-        new_page.right = None
-        return new_page
+def archive_page_changes(new_page, original_page):
+    '''Turns a copy of a live page into an archived version of it.'''
+    new_page.version_for = original_page
+    new_page.left = None
+    new_page.right = None
+    return new_page
 
-    if not page.version_for:
-        return False
 
-    live_page = page.version_for
+PublishResult = namedtuple('PublishResult', ['page', 'live_page', 'duration', 'error'])
 
-    page_duplicate = duplicate_page(live_page, page_changes)
-    overlay_page_obj(live_page, page, commit=True)
 
-    # Update reversions
-    # Version.objects.get_for_object(live_page).update(object_id=page_duplicate.pk)
-    # Version.objects.get_for_object(page).update(object_id=live_page.pk)
+def publish_pages(pages):
+    '''
+    Publishes the given draft versions of pages over their live pages, keeping
+    the live pages as archived versions.
+
+    All of the drafts are published in one transaction, and each draft is
+    archived, laid over its live page and deleted in its own savepoint, so
+    that one failure rolls back only that draft and doesn't stop the rest.
+    When there are several drafts for the same live page, they are published
+    oldest first, and the live page is archived before each of them. The
+    search index is updated once, at the end.
+
+    Returns a PublishResult for each draft, in the order given, with the live
+    page (or None if publishing failed), the time it took and the error, if
+    any.
+    '''
+    pages = [page for page in pages if page.version_for_id]
+    if not pages:
+        return []
 
-    page.delete()
+    # Deleted drafts lose their primary key, so results are kept by identity.
+    results = {}
+    with update_index():
+        live_pages = Page._base_manager.in_bulk([page.version_for_id for page in pages])
+
+        drafts_by_live_page = {}
+        for page in pages:
+            live_page = live_pages.get(page.version_for_id)
+            if live_page is None:
+                error = Page.DoesNotExist(f'The live page of "{page}" no longer exists.')
+                results[id(page)] = PublishResult(page, None, 0, error)
+                continue
+            page.version_for = live_page
+            drafts_by_live_page.setdefault(live_page.pk, []).append(page)
+        if not drafts_by_live_page:
+            return [results[id(page)] for page in pages]
+
+        for drafts in drafts_by_live_page.values():
+            drafts.sort(key=lambda page: (
+                page.version_publication_date is not None,
+                page.version_publication_date,
+                page.pk,
+            ))
+        prefetch_page_content(
+            [page for drafts in drafts_by_live_page.values() for page in drafts]
+            + [live_pages[live_page_id] for live_page_id in drafts_by_live_page]
+        )
+
+        with transaction.atomic():
+            for live_page_id, drafts in drafts_by_live_page.items():
+                live_page = live_pages[live_page_id]
+                for page in drafts:
+                    start = time.monotonic()
+                    try:
+                        with transaction.atomic():
+                            duplicate_pages([live_page], archive_page_changes)
+                            overlay_page_obj(live_page, page, commit=True)
+
+                            # Update reversions
+                            # Version.objects.get_for_object(live_page).update(object_id=page_duplicate.pk)
+                            # Version.objects.get_for_object(page).update(object_id=live_page.pk)
+
+                            page.delete()
+                    except Exception as error:  # pylint:disable=broad-except
+                        # The savepoint has rolled back the archive and the
+                        # overlay, so forget what was laid over the live page.
+                        live_page.refresh_from_db()
+                        live_page.__dict__.pop('content', None)
+                        results[id(page)] = PublishResult(page, None, time.monotonic() - start, error)
+                    else:
+                        results[id(page)] = PublishResult(page, live_page, time.monotonic() - start, None)
+
+    return [results[id(page)] for page in pages]
 
-    return live_page
+
+def publish_page(page):
+    if not page.version_for:
+        return False
+
+    result = publish_pages([page])[0]
+    if result.error is not None:
+        raise result.error
+
+    return result.live_page
 
 
 class PageTree:
-    '''A page tree for when you can't trust `left` and `right` attributes'''
+    '''A page tree for when you can't trust `left` and `right` attributes
+
+    Notes
+    -----
+    - Loads every page in the tree with a single query
+    - Works out ``left`` and ``right`` without recursion, so deep trees are fine
+    - Puts children in the order of their current ``left`` values
+    '''
+
+    def __init__(self, obj, db_alias=None, model=Page, child_filter=Q(is_canonical_page=True), gap=0):
+        '''
+        Parameters
+        ----------
+        obj
+            The root page of the tree.
+        db_alias
+            Passed to the ``using`` method of querysets if present.
+        model
+            The type of page model this tree holds (defaults to cms.apps.pages.models.Page).
+        child_filter: Q
+            A Q object to additionally filter the pages in the tree by.
+        gap: int
+            The number of unused values to leave at the end of each page's
+            range, so that later inserts can fill them (defaults to 0).
+        '''
+        queryset = model.objects.using(db_alias) if db_alias else model.objects
+        if child_filter:
+            queryset = queryset.filter(child_filter)
+        pages = list(queryset.only('id', 'parent_id', 'left', 'right', 'title', 'short_title').order_by('left', 'pk'))
+
+        pages_by_parent = {}
+        for page in pages:
+            pages_by_parent.setdefault(page.parent_id, []).append(page)
+
+        self.root = PageNode(obj, gap=gap)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node.children = [
+                PageNode(child, parent=node, gap=gap)
+                for child in pages_by_parent.get(node.obj.pk, ())
+            ]
+            stack.extend(node.children)
 
-    def __init__(self, obj, **kwargs):
-        self.root = PageNode(obj, **kwargs)
         self._pages_flat = []
 
+        # Pages whose parents never lead back to the root.
+        reached = set(page.pk for page in self.get_pages_flat())
+        self.orphans = [page for page in pages if page.pk not in reached]
+
+        self.set_mptt_attrs()
+
     def get_pages_flat(self):
         if not self._pages_flat:
             self._pages_flat = [self.root.obj] + [node.obj for node in self.root.all_children]
         return self._pages_flat
 
+    def set_mptt_attrs(self):
+        '''Works out the ``left`` and ``right`` values of every node.'''
+        value = 1
+        stack = [(self.root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                value += node.gap
+                node.rightattr = value
+            else:
+                node.leftattr = value
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+            value += 1
+
+    def get_changed_nodes(self):
+        '''Returns the nodes whose pages have the wrong ``left`` or ``right``.'''
+        return [
+            node for node in [self.root] + self.root.all_children
+            if (node.obj.left, node.obj.right) != (node.leftattr, node.rightattr)
+        ]
+
     def set_page_attrs(self):
-        self.root.set_page_attrs()
+        for node in [self.root] + self.root.all_children:
+            node.set_page_attrs()
 
     def __str__(self):
         return f'{self.root}\n\n' + self.root.children_as_str()
 
 
 class PageNode:
-    '''A Node in an MPTT tree.
-    - Recursively generates the tree from the given Page node
-    - Ignores ``left`` and ``right`` attributes set on the page and works out its own
+    '''A Node in an MPTT tree, built by ``PageTree``.'''
 
-    Notes
-    -----
-    - Puts children in the order given by `page.child_set`
-    - Most functions are recursive
-    '''
-    def __init__(self, obj, parent=None, db_alias=None, model=Page, child_filter=Q(is_canonical_page=True)):
+    def __init__(self, obj, parent=None, gap=0):
         '''
         Parameters
         ----------
@@ -214,68 +509,38 @@ class PageNode:
             The python object this node wraps.
         parent: PageNode
             The parent node (A value of ``None`` indicates this is the root node).
-        db_alias
-            Passed to the ``using`` method of querysets if present.
-        model
-            The type of page model this node wraps (defaults to cms.apps.pages.models.Page).
-        child_filter: Q
-            A Q object to additionally filter this node's children by.
+        gap: int
+            The number of unused values to leave before this node's ``right``.
         '''
         self.parent = parent
-        self.left = None
-        self.right = None
+        self.gap = gap
         self.leftattr = -1
         self.rightattr = -1
         self.obj = obj
-        child_set = model.objects.using(db_alias) if db_alias else model.objects
-        child_set = child_set.filter(parent=obj)
-        if child_filter:
-            child_set = child_set.filter(child_filter)
-        self.children = [PageNode(p, parent=self, model=model, child_filter=child_filter) for p in list(child_set.all())]
-        self.num_child_nodes = len(self.children) + sum([node.num_child_nodes for node in self.children])
-
-        self.set_mptt_attrs(None, None)
+        # The values the page had before set_page_attrs was called.
+        self.old_left = obj.left
+        self.old_right = obj.right
+        self.children = []
 
     def set_page_attrs(self):
         self.obj.left = self.leftattr
         self.obj.right = self.rightattr
-        for child in self.children:
-            child.set_page_attrs()
-
-    def set_mptt_attrs(self, left, right):
-        self.left = left
-        if left is None:
-            if self.parent:
-                self.leftattr = self.parent.leftattr + 1
-            else:
-                self.leftattr = 1
-        else:
-            self.leftattr = self.left.rightattr + 1
-
-        self.right = right
-        if self.children:
-            l = None
-            for i in range(0, len(self.children) - 1):
-                child = self.children[i]
-                r = self.children[i + 1]
-                child.set_mptt_attrs(l, r)
-                l = child
-
-            self.children[-1].set_mptt_attrs(l, None)
-
-            self.rightattr = self.children[-1].rightattr + 1
-        else:
-            self.rightattr = self.leftattr + 1
 
     @property
     def all_children(self):
+        '''All the descendants of this node, in tree order.'''
         children = []
-        if self.children:
-            children += self.children
-            for child in self.children:
-                children += child.all_children
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            children.append(node)
+            stack.extend(reversed(node.children))
         return children
 
+    @property
+    def num_child_nodes(self):
+        return len(self.all_children)
+
     def __str__(self):
         return f'<{self.leftattr} {self.obj} {self.rightattr}>'
 
@@ -288,9 +553,29 @@ class PageNode:
         return f'[{children}]' + ('\n\n' + sub_children if sub_children else '')
 
 
-def mptt_fix():
-    with publication_manager.select_published(False):
+def mptt_fix(gap=None, dry_run=False):
+    '''
+    Renumbers the whole page tree, leaving ``gap`` unused values in each
+    page's range (defaults to the PAGES_TREE_GAP setting).
+
+    Returns the tree nodes whose pages had the wrong ``left`` or ``right``,
+    and the canonical pages that couldn't be reached from the homepage and
+    were left alone. If ``dry_run`` is True, nothing is written.
+    '''
+    if gap is None:
+        gap = get_page_tree_gap()
+
+    with publication_manager.select_published(False), transaction.atomic():
+        if not dry_run:
+            # Stop pages being inserted or moved while the tree is renumbered.
+            lock_page_tree()
         homepage = Page.objects.get_homepage()
-        tree = PageTree(homepage)
-        tree.set_page_attrs()
-        Page.objects.bulk_update(tree.get_pages_flat(), ['left', 'right'])
+        tree = PageTree(homepage, gap=gap)
+        changed_nodes = tree.get_changed_nodes()
+        if dry_run:
+            return changed_nodes, tree.orphans
+        for node in changed_nodes:
+            node.set_page_attrs()
+        Page.objects.bulk_update([node.obj for node in changed_nodes], ['left', 'right'], batch_size=500)
+    invalidate_page_tree()
+    return changed_nodes, tree.orphans
@@ -1,10 +1,11 @@
-from django.contrib.contenttypes.models import ContentType
-from django.urls import resolve, is_valid_path, Resolver404
+from django.urls import Resolver404
 from django.conf import settings
 from django.shortcuts import redirect
 from django.http import Http404
 from django.views.generic import TemplateView, View
 
+from .models import content_registry, resolve_cached
+
 
 class PageDispatcherView(View):
     def dispatch(self, request, *args, **kwargs):
@@ -16,14 +17,20 @@ class PageDispatcherView(View):
 
         # Dispatch to the content.
         try:
-            callback, callback_args, callback_kwargs = resolve(request.pages.current_path, page.content.urlconf)
-
+            urlconf = content_registry.get(page.content_type_id).urlconf
+            # A page whose content model no longer exists has nothing to
+            # dispatch to, and mustn't fall back to the root urlconf.
+            match = resolve_cached(request.pages.current_path, urlconf) if urlconf is not None else None
+            if match is None:
+                raise Resolver404
+
+            callback, callback_args, callback_kwargs = match
             response = callback(request, *callback_args, **callback_kwargs)
 
         except Resolver404:
             raise Http404(f'No page or matching URL pattern found for "{request.pages.current_path[1:]}"')
 
-        if page.auth_required() and not request.user.is_authenticated:
+        if request.pages.auth_required and not request.user.is_authenticated:
             return redirect('{}?next={}'.format(
                 settings.LOGIN_URL,
                 request.path
@@ -46,13 +53,4 @@ class ContentIndexView(TemplateView):
         example/base.html
         base.html
         '''
-        content_cls = ContentType.objects.get_for_id(self.request.pages.current.content_type_id).model_class()
-        params = {
-            'model_name': content_cls.__name__.lower(),
-            'app_label': content_cls._meta.app_label,
-        }
-        return (
-            '{app_label}/{model_name}.html'.format(**params),
-            '{app_label}/base.html'.format(**params),
-            'base.html',
-        )
+        return content_registry.get(self.request.pages.current.content_type_id).template_names
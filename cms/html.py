@@ -1,8 +1,17 @@
 """HTML processing routines."""
+import functools
+import hashlib
 import re
+import threading
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.utils.html import escape
 from sorl.thumbnail import get_thumbnail
 
@@ -13,85 +22,392 @@ RE_TAG = re.compile(r"<(img|a)(\s+.*?)(/?)>", re.IGNORECASE)
 RE_ATTR = re.compile(r"\s([\w-]+)=(\".*?\"|'.*?')", re.IGNORECASE)
 
 
-def process(text):
+RE_PERMALINK_ATTRS = {
+    'a': ('href', re.compile(r"\shref=(?:\"(.*?)\"|'(.*?)')")),
+    'img': ('src', re.compile(r"\ssrc=(?:\"(.*?)\"|'(.*?)')")),
+}
+
+
+Thumbnail = namedtuple('Thumbnail', ['url', 'width', 'height'])
+
+
+def thumbnail_async_enabled():
+    """Returns True if thumbnails in HTML should be generated in the background."""
+    return getattr(settings, 'HTML_THUMBNAIL_ASYNC', False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_field_name(model):
+    """Returns the name of the last FileField on the given model, or None."""
+    fieldname = None
+    for field in model._meta.fields:
+        if isinstance(field, models.FileField):
+            fieldname = field.name
+    return fieldname
+
+
+def generate_thumbnail(file, geometry):
+    """Generates a thumbnail of the image, or returns None if it can't be."""
+    try:
+        thumbnail = get_thumbnail(file, geometry, quality=99, format="PNG")
+    except IOError:
+        return None
+    return Thumbnail(thumbnail.url, thumbnail.width, thumbnail.height)
+
+
+class ThumbnailPool:
+
     """
-    Expands permalinks in <a/> and <img/> tags.
+    Generates thumbnails in background threads.
 
-    Images will also be automatically thumbnailed to fit their specified width
-    and height.
+    Finished thumbnails are kept in the default cache. A thumbnail that is
+    asked for again while it is being generated is not queued again.
     """
-    resolved_permalinks = {}
 
-    def sub_tag(match):
-        tagname = match.group(1)
-        attrs = dict(RE_ATTR.findall(match.group(2)))
+    key_prefix = 'cms.html.thumbnail'
+
+    def __init__(self):
+        """Initializes the ThumbnailPool."""
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+
+    def get_key(self, file, geometry):
+        key = repr((file.storage.__class__.__name__, file.name, geometry))
+        return '{}.{}'.format(self.key_prefix, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def _generate(self, key, file, geometry):
+        try:
+            thumbnail = generate_thumbnail(file, geometry)
+            # Failures are remembered too, so that they aren't retried on
+            # every request.
+            cache.set(key, thumbnail or False, getattr(settings, 'HTML_THUMBNAIL_CACHE_TIMEOUT', 3600))
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+            close_old_connections()
+
+    def get(self, file, geometry):
+        """
+        Returns the thumbnail of the image, False if it couldn't be generated,
+        or None if it hasn't been generated yet, queueing it if it isn't
+        already queued.
+        """
+        key = self.get_key(file, geometry)
+        thumbnail = cache.get(key)
+        if thumbnail is not None:
+            return thumbnail
+
+        with self._lock:
+            if key not in self._pending:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, 'HTML_THUMBNAIL_WORKERS', 2),
+                    )
+                self._pending.add(key)
+                self._executor.submit(self._generate, key, file, geometry)
+        return None
+
+    def wait(self):
+        """Waits for every queued thumbnail to be generated."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+# A single thumbnail pool for the process.
+thumbnails = ThumbnailPool()
+
 
-        def get_obj(attr_name):
-            if attr_name in attrs:
-                value = attrs[attr_name][1:-1]
-                if value not in resolved_permalinks:
-                    try:
-                        resolved_permalinks[value] = permalinks.resolve(value)
-                    except (permalinks.PermalinkError, ObjectDoesNotExist):
-                        resolved_permalinks[value] = None
-                obj = resolved_permalinks[value]
-                if obj:
-                    # Add in the URL of the obj.
-                    attrs[attr_name] = '"%s"' % escape(obj.get_absolute_url())
-                    # Add in the title of the obj.
-                    attrs.setdefault("title", '"%s"' % escape(getattr(obj, "title", str(obj))))
-                return obj
-            return None
-
-        if tagname == "a":
-            # Process hyperlinks.
-            obj = get_obj("href")
-        elif tagname == "img":
-            # Process images.
-            obj = get_obj("src")
-
-            if obj:
-                if hasattr(obj, 'attribution') or hasattr(obj, 'copyright'):
-                    attrs["title"] = ''
-
-                    if hasattr(obj, 'copyright') and obj.copyright:
-                        attrs["title"] += '&copy; {}. '.format(
-                            obj.copyright,
-                        )
-
-                    if hasattr(obj, 'attribution') and obj.attribution:
-                        attrs["title"] += obj.attribution
-
-                    if attrs["title"]:
-                        attrs["title"] = '"{}"'.format(attrs["title"])
-                    else:
-                        attrs["title"] = '"{}"'.format(obj.title)
-
-                try:
-                    width = int(attrs["width"][1:-1])
-                    height = int(attrs["height"][1:-1])
-                except (ValueError, KeyError, TypeError):
-                    pass
-                else:
-                    # Automagically detect a FileField.
-                    fieldname = None
-                    for field in obj._meta.fields:
-                        if isinstance(field, models.FileField):
-                            fieldname = field.name
-                    # Generate the thumbnail.
-                    if fieldname:
-                        try:
-                            thumbnail = get_thumbnail(getattr(obj, fieldname), '{}x{}'.format(width, height), quality=99, format="PNG")
-                        except IOError:
-                            pass
-                        else:
-                            attrs["src"] = '"%s"' % escape(thumbnail.url)
-                            attrs["width"] = '"%s"' % thumbnail.width
-                            attrs["height"] = '"%s"' % thumbnail.height
+def get_image_thumbnail(file, width, height, pending=None):
+    """
+    Returns a thumbnail of the image to fit the given size, or None if it
+    can't be generated.
+
+    If a list of pending thumbnails is given and HTML_THUMBNAIL_ASYNC is set,
+    thumbnails that haven't been generated yet are queued instead, and
+    added to the list, and None is returned straight away.
+    """
+    geometry = '{}x{}'.format(width, height)
+    if pending is None or not thumbnail_async_enabled():
+        return generate_thumbnail(file, geometry)
+
+    thumbnail = thumbnails.get(file, geometry)
+    if thumbnail is None:
+        pending.append((file.name, geometry))
+    return thumbnail or None
+
+
+def process_tag(tagname, attrs, closing, attr_name, obj, pending=None):
+    """
+    Regenerates a tag that references the given object with a permalink,
+    expanding the permalink and adding the object's title.
+
+    Images that are still being thumbnailed keep their original source; see
+    get_image_thumbnail.
+    """
+    # Add in the URL of the obj.
+    attrs[attr_name] = '"%s"' % escape(obj.get_absolute_url())
+    # Add in the title of the obj.
+    attrs.setdefault("title", '"%s"' % escape(getattr(obj, "title", str(obj))))
+
+    if tagname == "img":
+        # Process images.
+        if hasattr(obj, 'attribution') or hasattr(obj, 'copyright'):
+            attrs["title"] = ''
+
+            if hasattr(obj, 'copyright') and obj.copyright:
+                attrs["title"] += '&copy; {}. '.format(
+                    obj.copyright,
+                )
+
+            if hasattr(obj, 'attribution') and obj.attribution:
+                attrs["title"] += obj.attribution
+
+            if attrs["title"]:
+                attrs["title"] = '"{}"'.format(attrs["title"])
+            else:
+                attrs["title"] = '"{}"'.format(obj.title)
+
+        try:
+            width = int(attrs["width"][1:-1])
+            height = int(attrs["height"][1:-1])
+        except (ValueError, KeyError, TypeError):
+            pass
         else:
+            # Automagically detect a FileField.
+            fieldname = get_file_field_name(obj._meta.model)
+            # Generate the thumbnail.
+            if fieldname:
+                thumbnail = get_image_thumbnail(getattr(obj, fieldname), width, height, pending)
+                if thumbnail:
+                    attrs["src"] = '"%s"' % escape(thumbnail.url)
+                    attrs["width"] = '"%s"' % thumbnail.width
+                    attrs["height"] = '"%s"' % thumbnail.height
+
+    # Regenerate the html tag.
+    attrs_str = " ".join("%s=%s" % (key, value) for key, value in sorted(attrs.items()))
+    return "<%s %s%s>" % (tagname, attrs_str, closing)
+
+
+def scan_tags(text):
+    """
+    Returns the tags in the text that may reference a permalink, as a list of
+    the tag's match, the name of its permalink attribute and the values of
+    that attribute.
+    """
+    tags = []
+    for match in RE_TAG.finditer(text):
+        try:
+            attr_name, re_attr = RE_PERMALINK_ATTRS[match.group(1)]
+        except KeyError:
             assert False
 
-        # Regenerate the html tag.
-        attrs_str = " ".join("%s=%s" % (key, value) for key, value in sorted(attrs.items()))
-        return "<%s %s%s>" % (tagname, attrs_str, match.group(3))
-    return RE_TAG.sub(sub_tag, text)
+        # Look for a permalink without parsing the rest of the attributes.
+        values = [double or single for double, single in re_attr.findall(match.group(2))]
+        if values:
+            tags.append((match, attr_name, values))
+    return tags
+
+
+def substitute_tags(text, tags, resolved_permalinks, pending=None):
+    """
+    Regenerates the scanned tags that reference one of the resolved
+    permalinks, copying the rest of the text as it is.
+    """
+    output = []
+    position = 0
+    for match, attr_name, values in tags:
+        if not any(resolved_permalinks.get(value) for value in values):
+            continue
+
+        attrs = dict(RE_ATTR.findall(match.group(2)))
+        obj = resolved_permalinks.get(attrs[attr_name][1:-1]) if attr_name in attrs else None
+        if not obj:
+            continue
+
+        output.append(text[position:match.start()])
+        output.append(process_tag(match.group(1), attrs, match.group(3), attr_name, obj, pending))
+        position = match.end()
+
+    if not output:
+        return text
+    output.append(text[position:])
+    return "".join(output)
+
+
+def html_cache_enabled():
+    """Returns True if processed HTML should be cached."""
+    return getattr(settings, 'HTML_CACHE', False)
+
+
+def get_dependency_key(model, pk):
+    """
+    Returns the cache key of the version of an object that processed HTML
+    depends on.
+    """
+    # Permalinks always refer to the concrete model, but signals are sent
+    # for proxy models too.
+    model = model._meta.concrete_model
+    if model._meta.label == 'pages.Page':
+        # The URL of a page depends on its ancestors, so use the version of
+        # the whole page tree, which changes whenever any page is saved.
+        from cms.apps.pages.tree import page_tree
+        return page_tree.version_key
+    return 'cms.html.version.{}.{}'.format(model._meta.label_lower, pk)
+
+
+def get_dependency_versions(keys):
+    """
+    Returns the current versions of the given dependency keys, creating any
+    that don't exist yet.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def dependency_changed(sender, instance, **kwargs):
+    if not html_cache_enabled():
+        return
+
+    key = get_dependency_key(sender, instance.pk)
+
+    def invalidate():
+        cache.delete(key)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def connect_signals():
+    """
+    Connects the signal handlers that keep the processed HTML cache up to
+    date to every model that can be linked to with a permalink.
+    """
+    for model in apps.get_models():
+        # Only objects with a URL can be linked to with a permalink. Pages are
+        # covered by the page tree version.
+        if not hasattr(model, 'get_absolute_url') or model._meta.label == 'pages.Page':
+            continue
+        post_save.connect(dependency_changed, sender=model)
+        post_delete.connect(dependency_changed, sender=model)
+
+
+def _process_many(texts, wait_for_thumbnails=False, track_dependencies=False):
+    """
+    Expands permalinks in each of the given texts, returning the processed
+    texts, the versions of the objects that each of them depends on and
+    whether any of their thumbnails are still being generated.
+
+    The versions are only looked up if track_dependencies is True. They are
+    read before the linked objects are fetched, so an object saved while the
+    texts are processed makes them stale rather than being missed.
+    """
+    scanned_tags = [scan_tags(text) for text in texts]
+    parsed_permalinks = permalinks.parse_many(
+        value
+        for tags in scanned_tags
+        for _, _, values in tags
+        for value in values
+    )
+    versions = {}
+    if track_dependencies:
+        versions = get_dependency_versions(set(
+            get_dependency_key(model, pk)
+            for model, pk in parsed_permalinks.values()
+        ))
+    resolved_permalinks = permalinks.resolve_many(parsed_permalinks, parsed_permalinks)
+
+    processed = []
+    for text, tags in zip(texts, scanned_tags):
+        dependencies = {}
+        if track_dependencies:
+            for _, _, values in tags:
+                for value in values:
+                    if value in parsed_permalinks:
+                        key = get_dependency_key(*parsed_permalinks[value])
+                        dependencies[key] = versions[key]
+        pending = None if wait_for_thumbnails else []
+        processed.append((
+            substitute_tags(text, tags, resolved_permalinks, pending),
+            tuple(dependencies.items()),
+            bool(pending),
+        ))
+    return processed
+
+
+def process_many(texts, wait_for_thumbnails=False):
+    """
+    Expands permalinks in each of the given texts, returning the processed
+    texts in the same order.
+
+    Every permalink in the texts is collected first and the linked objects
+    are fetched with one query for each type of object, so rendering many
+    rich-text fields together costs no more queries than rendering one.
+
+    If HTML_CACHE is set, the processed texts are cached by a hash of the
+    source text along with the versions of the objects they link to, so they
+    are processed again only when one of those objects is saved.
+
+    If HTML_THUMBNAIL_ASYNC is set, images are thumbnailed in the background
+    and keep their original source until their thumbnail is ready, unless
+    wait_for_thumbnails is True. Texts with pending thumbnails aren't cached.
+    """
+    texts = list(texts)
+    if not html_cache_enabled():
+        return [text for text, _, _ in _process_many(texts, wait_for_thumbnails)]
+
+    keys = [
+        'cms.html.{}'.format(hashlib.sha1(text.encode('utf-8')).hexdigest())
+        for text in texts
+    ]
+    entries = cache.get_many(set(keys))
+    versions = cache.get_many(set(
+        key
+        for dependencies, _ in entries.values()
+        for key, _ in dependencies
+    ))
+
+    output = {}
+    for key, (dependencies, text) in entries.items():
+        if all(versions.get(dependency_key) == version for dependency_key, version in dependencies):
+            output[key] = text
+
+    missing = dict(
+        (key, text)
+        for key, text in zip(keys, texts)
+        if key not in output
+    )
+    if missing:
+        processed = dict(zip(missing, _process_many(list(missing.values()), wait_for_thumbnails, True)))
+        cache.set_many(
+            dict(
+                (key, (dependencies, text))
+                for key, (text, dependencies, pending) in processed.items()
+                if not pending
+            ),
+            getattr(settings, 'HTML_CACHE_TIMEOUT', 3600),
+        )
+        for key, (text, _, _) in processed.items():
+            output[key] = text
+
+    return [output[key] for key in keys]
+
+
+def process(text, wait_for_thumbnails=False):
+    """
+    Expands permalinks in <a/> and <img/> tags.
+
+    Images will also be automatically thumbnailed to fit their specified width
+    and height.
+
+    The text is scanned once. Only tags that reference a permalink are
+    regenerated; everything else is copied to the output exactly as it was,
+    and text without any permalinks is returned as it is.
+    """
+    return process_many([text], wait_for_thumbnails)[0]
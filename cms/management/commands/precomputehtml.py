@@ -0,0 +1,73 @@
+from django.apps import apps
+from django.core.management import BaseCommand
+
+from cms.html import process_many
+from cms.models import HtmlField
+
+
+class Command(BaseCommand):
+    '''
+        Regenerates the precomputed HTML of every HtmlField with precompute=True.
+        Run this after pages or files that are linked from HTML have moved.
+    '''
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='The number of rows to process and update at a time.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for model in apps.get_models():
+            fields = [
+                field for field in model._meta.local_concrete_fields
+                if isinstance(field, HtmlField) and field.precompute
+            ]
+            if not fields:
+                continue
+
+            rendered_names = [field.rendered_name for field in fields]
+            queryset = model._base_manager.only(
+                *[field.name for field in fields] + rendered_names
+            ).order_by('pk')
+
+            count = 0
+            updated = 0
+            last_pk = None
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                objs = list(batch[:batch_size])
+                if not objs:
+                    break
+                last_pk = objs[-1].pk
+                count += len(objs)
+
+                # The permalinks of the whole batch are resolved together.
+                rendered = iter(process_many(
+                    (
+                        getattr(obj, field.attname) or ''
+                        for obj in objs
+                        for field in fields
+                    ),
+                    wait_for_thumbnails=True,
+                ))
+
+                changed_objs = []
+                for obj in objs:
+                    changed = False
+                    for field in fields:
+                        value = next(rendered)
+                        if getattr(obj, field.rendered_name) != value:
+                            setattr(obj, field.rendered_name, value)
+                            changed = True
+                    if changed:
+                        changed_objs.append(obj)
+
+                if changed_objs:
+                    model._base_manager.bulk_update(changed_objs, rendered_names)
+                    updated += len(changed_objs)
+
+            self.stdout.write(f'Updated {updated} of {count} {model._meta.verbose_name_plural}')
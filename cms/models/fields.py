@@ -8,7 +8,46 @@ from django.db import models
 
 class HtmlField(models.TextField):
 
-    '''A field that contains HTML data.'''
+    '''
+    A field that contains HTML data.
+
+    If `precompute` is True, the HTML is processed with `cms.html.process`
+    whenever the field is saved, and the result is stored in a companion
+    `<name>_rendered` field that templates can output as it is.
+    '''
+
+    def __init__(self, *args, precompute=False, **kwargs):
+        '''Initializes the HtmlField.'''
+        self.precompute = precompute
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.precompute:
+            kwargs['precompute'] = True
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        '''Adds in a field for the precomputed HTML.'''
+        super().contribute_to_class(cls, name, **kwargs)
+        self.rendered_name = '{}_rendered'.format(name)
+
+        # Abstract models pass the field on to their subclasses, and models
+        # rebuilt from migrations already have the rendered field.
+        if self.precompute and not cls._meta.abstract and cls.__module__ != '__fake__':
+            cls.add_to_class(self.rendered_name, models.TextField(
+                blank=True,
+                editable=False,
+            ))
+
+    def pre_save(self, model_instance, add):
+        '''Processes the HTML into the rendered field.'''
+        from cms.html import process as process_html
+
+        value = super().pre_save(model_instance, add)
+        if self.precompute:
+            setattr(model_instance, self.rendered_name, process_html(value, wait_for_thumbnails=True) if value else '')
+        return value
 
     def formfield(self, **kwargs):
         '''Returns a HtmlWidget.'''
@@ -8,9 +8,10 @@ to change its absolute URL without breaking links.
 from django import urls
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.views import shortcut
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import (ImproperlyConfigured, ObjectDoesNotExist,
+                                    ValidationError)
 
-__all__ = ('PermalinkError', 'create', 'resolve', 'expand',)
+__all__ = ('PermalinkError', 'create', 'resolve', 'parse_many', 'resolve_many', 'expand',)
 
 
 class PermalinkError(Exception):
@@ -27,12 +28,11 @@ def create(obj):
     return urls.reverse('permalink_redirect', kwargs=kwargs)
 
 
-def resolve(permalink):
+def _parse(permalink):
     '''
-    Resolves the given permalink into an object.
+    Returns the content type ID and object ID encoded in the given permalink.
 
-    Raises a PermalinkError if the URL is not a valid permalink. Raises an
-    ObjectDoesNotExist if the referenced object does not exist.
+    Raises a PermalinkError if the URL is not a valid permalink.
     '''
     # Attempt to resolve the URL.
     try:
@@ -44,16 +44,78 @@ def resolve(permalink):
         raise PermalinkError("'{}' is not a valid permalink.".format(permalink))
     # Get the permalink attributes.
     try:
-        content_type_id = callback_kwargs['content_type_id']
-        object_id = callback_kwargs['object_id']
+        return callback_kwargs['content_type_id'], callback_kwargs['object_id']
     except KeyError:
         raise ImproperlyConfigured('The permalink_redirect view should be configured using keyword arguments.')
+
+
+def resolve(permalink):
+    '''
+    Resolves the given permalink into an object.
+
+    Raises a PermalinkError if the URL is not a valid permalink. Raises an
+    ObjectDoesNotExist if the referenced object does not exist.
+    '''
+    content_type_id, object_id = _parse(permalink)
     # Resolve the object.
     content_type = ContentType.objects.get_for_id(content_type_id)
     obj = content_type.get_object_for_this_type(id=object_id)
     return obj
 
 
+def parse_many(permalinks):
+    '''
+    Returns the model and primary key encoded in each of the given
+    permalinks, as a dictionary by permalink, without fetching any objects.
+
+    Permalinks that are not valid, or whose model no longer exists, are left
+    out.
+    '''
+    parsed = {}
+    for permalink in set(permalinks):
+        try:
+            content_type_id, object_id = _parse(permalink)
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+        except (PermalinkError, ObjectDoesNotExist):
+            continue
+        if model is None:
+            continue
+
+        try:
+            parsed[permalink] = (model, model._meta.pk.to_python(object_id))
+        except ValidationError:
+            pass
+    return parsed
+
+
+def resolve_many(permalinks, parsed=None):
+    '''
+    Resolves the given permalinks into objects, with one query for each type
+    of object.
+
+    Returns a dictionary of the objects by permalink. Permalinks that are not
+    valid, or whose objects do not exist, are mapped to None. If the
+    permalinks have already been parsed with parse_many(), its result can be
+    passed as parsed to avoid parsing them again.
+    '''
+    resolved = dict.fromkeys(permalinks)
+    if parsed is None:
+        parsed = parse_many(resolved)
+
+    pks = {}
+    for permalink in resolved:
+        if permalink in parsed:
+            model, pk = parsed[permalink]
+            pks.setdefault(model, {})[permalink] = pk
+
+    for model, model_pks in pks.items():
+        objects = model._base_manager.in_bulk(set(model_pks.values()))
+        for permalink, pk in model_pks.items():
+            resolved[permalink] = objects.get(pk)
+
+    return resolved
+
+
 def expand(permalink):
     '''
     Expands the given permalink into a full URL.
@@ -1,6 +1,8 @@
 import base64
+import os
 import random
 import re
+import threading
 
 from unittest import mock
 from django.contrib.contenttypes.models import ContentType
@@ -10,7 +12,7 @@ from django.utils import six
 from django.utils.timezone import now
 
 from ..apps.media.models import File
-from ..html import process
+from ..html import process, process_many, thumbnails
 
 
 class TestHTML(TestCase):
@@ -126,3 +128,80 @@ class TestHTML(TestCase):
         with mock.patch('cms.html.RE_TAG', new=re_tag), \
                 self.assertRaises(AssertionError):
             process('<ab />')
+
+    def test_process__corpus(self):
+        with open(os.path.join(os.path.dirname(__file__), 'corpus', 'tinymce.html')) as corpus_file:
+            corpus = corpus_file.read()
+
+        # Text without permalinks is returned as it is.
+        string = corpus.replace('PERMALINK_IMAGE', '/static/img/office.png').replace('PERMALINK_PAGE', '/contact/')
+        self.assertIs(process(string), string)
+
+        # Only the tags with permalinks are changed, and they are changed in
+        # the same way as they are on their own.
+        content_type = ContentType.objects.get_for_model(File).pk
+        permalink = '/r/{}-{}/'.format(content_type, self.image_attribution.pk)
+        string = corpus.replace('PERMALINK_IMAGE', permalink).replace('PERMALINK_PAGE', '/contact/')
+        tags = re.findall(r'<img [^>]*{}[^>]*>'.format(re.escape(permalink)), string)
+        self.assertEqual(len(tags), 2)
+
+        with mock.patch('cms.html.get_thumbnail', side_effect=IOError):
+            output = process(string)
+            expected = string
+            for tag in tags:
+                expected = expected.replace(tag, process(tag))
+
+        self.assertEqual(output, expected)
+        self.assertNotIn(permalink, output)
+        self.assertIn('title="Foo attribution"', output)
+
+    def test_process_many(self):
+        content_type = ContentType.objects.get_for_model(File).pk
+        strings = [
+            '<img src="/r/{}-{}/"/>'.format(content_type, image.pk)
+            for image in (self.image, self.image_copyright, self.image_attribution)
+        ] + ['<a href="/">Link</a>']
+
+        with self.assertNumQueries(1):
+            output = process_many(strings)
+
+        self.assertEqual(output, [process(string) for string in strings])
+
+    def test_process__cache(self):
+        content_type = ContentType.objects.get_for_model(File).pk
+        string = '<p><img src="/r/{}-{}/"/></p>'.format(content_type, self.image.pk)
+
+        with self.settings(HTML_CACHE=True):
+            output = process(string)
+            self.assertIn('title="Foo"', output)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(process(string), output)
+
+            # Saving a linked object invalidates the text that links to it.
+            self.image.title = 'Bar'
+            self.image.save()
+            self.assertIn('title="Bar"', process(string))
+
+    def test_process__thumbnail_async(self):
+        content_type = ContentType.objects.get_for_model(File).pk
+        string = '<img src="/r/{}-{}/" width="10" height="10"/>'.format(content_type, self.image.pk)
+        thumbnail = mock.Mock(url='/media/cache/thumbnail.png', width=10, height=8)
+        resize = threading.Event()
+
+        def generate_thumbnail(*args, **kwargs):
+            resize.wait(5)
+            return thumbnail
+
+        with self.settings(HTML_THUMBNAIL_ASYNC=True), \
+                mock.patch('cms.html.get_thumbnail', side_effect=generate_thumbnail) as get_thumbnail:
+            # The original image is used until the thumbnail is ready, and
+            # it is only generated once.
+            for _ in range(2):
+                self.assertIn('src="' + self.image.file.url + '"', process(string))
+            resize.set()
+            thumbnails.wait()
+            self.assertEqual(get_thumbnail.call_count, 1)
+
+            self.assertIn('src="/media/cache/thumbnail.png"', process(string))
+            self.assertEqual(get_thumbnail.call_count, 1)
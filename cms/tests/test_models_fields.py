@@ -1,9 +1,13 @@
+from io import StringIO
+
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.db import models
 from django.test import TestCase
 
-from ..models.fields import (LinkField, LinkResolutionError, link_validator,
-                             resolve_link)
+from ..models.fields import (HtmlField, LinkField, LinkResolutionError,
+                             link_validator, resolve_link)
 
 
 class TestFieldsModel(models.Model):
@@ -11,6 +15,26 @@ class TestFieldsModel(models.Model):
     link = LinkField()
 
 
+class TestPrecomputedHtmlModel(models.Model):
+
+    content = HtmlField(
+        precompute=True,
+    )
+
+
+class TestLinkedModel(models.Model):
+
+    url = models.CharField(
+        max_length=100,
+    )
+
+    def __str__(self):
+        return 'Linked'
+
+    def get_absolute_url(self):
+        return self.url
+
+
 class TestFields(TestCase):
 
     def test_resolve_link(self):
@@ -33,3 +57,26 @@ class TestFields(TestCase):
         )
 
         self.assertEqual(obj.get_link_resolved(), 'http://[a')
+
+    def test_htmlfield_precompute(self):
+        self.assertEqual(HtmlField(precompute=True).deconstruct()[3], {'precompute': True})
+
+        linked = TestLinkedModel.objects.create(url='/foo/')
+        obj = TestPrecomputedHtmlModel.objects.create(
+            content='<a href="/r/{}-{}/">Foo</a>'.format(
+                ContentType.objects.get_for_model(TestLinkedModel).pk,
+                linked.pk,
+            ),
+        )
+        self.assertEqual(obj.content_rendered, '<a href="/foo/" title="Linked">Foo</a>')
+
+        # Moving the linked object leaves the HTML stale until the command
+        # is run.
+        linked.url = '/bar/'
+        linked.save()
+        obj.refresh_from_db()
+        self.assertEqual(obj.content_rendered, '<a href="/foo/" title="Linked">Foo</a>')
+
+        call_command('precomputehtml', stdout=StringIO())
+        obj.refresh_from_db()
+        self.assertEqual(obj.content_rendered, '<a href="/bar/" title="Linked">Foo</a>')
@@ -3,7 +3,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.test import TestCase
 
-from ..permalinks import PermalinkError, expand, resolve
+from ..permalinks import PermalinkError, expand, resolve, resolve_many
 
 
 class TestPermalinkModel(models.Model):
@@ -38,6 +38,20 @@ class PermalinksTest(TestCase):
 
         urls.set_urlconf(original_urlconf)
 
+    def test_resolve_many(self):
+        objs = [TestPermalinkModel.objects.create() for _ in range(3)]
+        content_type = ContentType.objects.get_for_model(TestPermalinkModel)
+        permalinks = ['/r/{}-{}/'.format(content_type.pk, obj.pk) for obj in objs]
+        missing = '/r/{}-{}/'.format(content_type.pk, objs[-1].pk + 1)
+
+        with self.assertNumQueries(1):
+            resolved = resolve_many(permalinks + permalinks + [missing, '/admin/'])
+
+        self.assertEqual(resolved, dict(zip(permalinks, objs), **{
+            missing: None,
+            '/admin/': None,
+        }))
+
     def test_expand(self):
         obj = TestPermalinkModel.objects.create()
 